@@ -8,19 +8,35 @@ import socket
 import threading
 import time
 import os
+import ctypes
 
-from scapy.all import Packet, IntField, ByteField, sniff
+from mcast_mmsg import batch_sender, batch_receiver
+from mcast_pacer import make_pacer
+from mcast_rates import make_tracker
+from mcast_feedback import suppressor
+import mcast_log
 
+try:
+    from scapy.all import Packet, IntField, ByteField, sniff
+except ImportError:
+    # only the 'sniff' receiver backend and the benchmarks need scapy
+    Packet = None
 
-class McastPkt(Packet):
-    name = "Mcast packet"
-    fields_desc = [
-        ByteField('mtype', 0), 
-        ByteField('prio', 0), 
-        IntField('crate', 0), 
-        IntField('nrate', 0)]
 
-McastPkt.size = len(McastPkt())
+# Precompiled wire format of McastPkt: mtype, prio, crate, nrate.
+MHEADER = struct.Struct('!BBII')
+
+if Packet is not None:
+    class McastPkt(Packet):
+        name = "Mcast packet"
+        fields_desc = [
+            ByteField('mtype', 0), 
+            ByteField('prio', 0), 
+            IntField('crate', 0), 
+            IntField('nrate', 0)]
+
+    McastPkt.size = len(McastPkt())
+    assert MHEADER.size == McastPkt.size
 
 
 CONFIG = dict(
@@ -33,7 +49,7 @@ CONFIG = dict(
     MCAST_NORMAL_ACK=6,
     probe_interval=.1,
     payload_size=1000,
-    mheader_size=14+20+8+McastPkt.size,
+    mheader_size=14+20+8+MHEADER.size,
     max_sending_rate=4000000, #2**31,
     MAX_PRIO_VLAUE=255,
     )
@@ -49,13 +65,90 @@ def pack_mcastpkt(mtype=0, prio=0, crate=0, nrate=0, payload="", payload_size=No
             payload = payload[:payload_size]
         else:
             payload = payload + bytearray(payload_size - len(payload))
-    header = McastPkt(mtype=mtype, prio=prio, crate=crate, nrate=nrate)
-    return bytes(header) + payload
+    return MHEADER.pack(mtype, prio, crate, nrate) + payload
 
 def unpack_mcastpkt(data):
-    header = McastPkt(data[:McastPkt.size])
-    payload = data[McastPkt.size:]
-    return dict(mtype=header.mtype, prio=header.prio, crate=header.crate, nrate=header.nrate, payload=payload, payload_size=len(payload))
+    mtype, prio, crate, nrate = MHEADER.unpack_from(data)
+    payload = data[MHEADER.size:]
+    return dict(mtype=mtype, prio=prio, crate=crate, nrate=nrate, payload=payload, payload_size=len(payload))
+
+
+class packer(object):
+    """
+    Packs mcast headers into a reusable, preallocated buffer.
+
+    The payload area is zero-filled once and never written again, so a
+    packet is just the header packed in place plus a slice of the buffer.
+    The returned memoryview is only valid until the next call to pack().
+    """
+    def __init__(self, payload_size=CONFIG['payload_size']):
+        self.buf = bytearray(MHEADER.size + payload_size)
+        self.view = memoryview(self.buf)
+
+    def pack(self, mtype=0, prio=0, crate=0, nrate=0, payload_size=0):
+        size = MHEADER.size + payload_size
+        if size > len(self.buf):
+            self.__init__(payload_size)
+        MHEADER.pack_into(self.buf, 0, mtype, prio, crate, nrate)
+        return self.view[:size]
+
+
+ETH_P_IP = 0x0800
+SO_ATTACH_FILTER = 26
+PACKET_OUTGOING = 4
+
+
+def udp_filter(listen_port, multicast_group=None):
+    """
+    Classic BPF program equivalent to the tcpdump filter
+    'ip and udp and dst port <listen_port> [and dst <multicast_group>]'
+    on Ethernet frames, as a list of (code, jt, jf, k) instructions.
+    """
+    insns = [
+        (0x28, 0, 0, 12),                   # ldh [12]
+        (0x15, 0, 'drop', ETH_P_IP),        # jeq #0x800
+        (0x30, 0, 0, 23),                   # ldb [23]
+        (0x15, 0, 'drop', socket.IPPROTO_UDP),  # jeq #17
+        (0x28, 0, 0, 20),                   # ldh [20]
+        (0x45, 'drop', 0, 0x1fff),          # jset #0x1fff (fragment)
+        (0xb1, 0, 0, 14),                   # ldxb 4*([14]&0xf)
+        (0x48, 0, 0, 16),                   # ldh [x + 16]
+        (0x15, 0, 'drop', listen_port),     # jeq #listen_port
+    ]
+    if multicast_group:
+        group, = struct.unpack('!I', socket.inet_aton(multicast_group))
+        insns += [
+            (0x20, 0, 0, 30),               # ld [30]
+            (0x15, 0, 'drop', group),       # jeq #multicast_group
+        ]
+    insns += [
+        (0x06, 0, 0, 0x40000),              # ret #262144
+        (0x06, 0, 0, 0),                    # drop: ret #0
+    ]
+    drop = len(insns) - 1
+    return [(code, drop - i - 1 if jt == 'drop' else jt, drop - i - 1 if jf == 'drop' else jf, k)
+            for i, (code, jt, jf, k) in enumerate(insns)]
+
+
+def attach_filter(sock, insns):
+    prog = ctypes.create_string_buffer(b''.join(struct.pack('HBBI', *ins) for ins in insns))
+    fprog = struct.pack('HL', len(insns), ctypes.addressof(prog))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+    # the kernel copies the program, but keep it alive with the socket anyway
+    return prog
+
+
+def parse_udp_frame(frame):
+    """
+    Return (udp payload, (ip src, udp sport)) of an Ethernet/IPv4/UDP frame,
+    or None if it is not one.
+    """
+    ethertype, vihl = struct.unpack_from('!HB', frame, 12)
+    if ethertype != ETH_P_IP or struct.unpack_from('!B', frame, 23)[0] != socket.IPPROTO_UDP:
+        return None
+    offset = 14 + (vihl & 0xf) * 4
+    sport, = struct.unpack_from('!H', frame, offset)
+    return frame[offset + 8:], (socket.inet_ntoa(frame[26:30]), sport)
 
 
 class receiver(object):
@@ -63,15 +156,40 @@ class receiver(object):
     https://www.tldp.org/HOWTO/Multicast-HOWTO-6.html
     https://pymotw.com/2/socket/multicast.html
     https://myopsblog.wordpress.com/2016/07/11/how-to-enable-multicast-on-linux-network-interface/
+
+    backend selects how data packets are captured:
+        sniff  -- scapy sniff() in promiscuous mode (default)
+        udp    -- a UDP socket that joins multicast_group with IP_ADD_MEMBERSHIP
+        packet -- an AF_PACKET socket with a kernel BPF filter; like sniff,
+                  it also works with the wildcard group 0.0.0.0
+
+    feedback_threshold, feedback_interval and feedback_window hold back
+    feedback, see mcast_feedback; all 0 answers every rate change.
     """
-    def __init__(self, multicast_group="224.1.2.3", listen_port=1234, **params):
+    backends = ('sniff', 'udp', 'packet')
+
+    def __init__(self, multicast_group="224.1.2.3", listen_port=1234, backend='sniff', **params):
+        if backend not in self.backends:
+            raise ValueError("Unknown receiver backend: " + str(backend))
         self.multicast_group = multicast_group
         self.listen_port = listen_port
+        self.backend = backend
         self.last_rate = 0
 
         self.echo_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.suppressor = suppressor(
+            threshold=params.get('feedback_threshold', 0),
+            interval=params.get('feedback_interval', 0),
+            window=params.get('feedback_window', 0))
         #self.logfile_name = "{0}-receiver.log".format(socket.gethostname())
         #os.system("echo  >> {0}".format(self.logfile_name))
+
+        # log_format='binary' keeps per-packet records in mcast_log rings
+        self.recorder = self.rx_log = None
+        if params.get('log_format', 'text') == 'binary':
+            log_file = params.get('log_file', None) or 'receiver-{0}.bin'.format(os.getpid())
+            self.recorder = mcast_log.recorder(log_file, sample=params.get('log_sample', 1))
+            self.rx_log = self.recorder.ring()
         
     def log(self, msg="", level=1):
         #sys.stderr.write(msg)
@@ -79,42 +197,85 @@ class receiver(object):
         msg = "{0:.6f}, {1}".format(time.time(), msg)
         sys.stdout.write(msg)
         
+    def is_wildcard(self):
+        return self.multicast_group == 0 or self.multicast_group == '0.0.0.0'
 
     def pkt_callback(self, pkt):
         peeraddr = (pkt['IP'].src, pkt['UDP'].sport)
-        t = unpack_mcastpkt(bytes(pkt['UDP'].payload))
+        self.handle(bytes(pkt['UDP'].payload), peeraddr)
+
+    def handle(self, data, peeraddr):
+        t = unpack_mcastpkt(data)
         if 'payload' in t:
             del t['payload']
-        self.log("received '%s' from %s\n" % (str(t), peeraddr))
+        if self.rx_log is not None:
+            self.rx_log.record(mcast_log.EVENT_RECEIVED, remote=peeraddr, **t)
+        else:
+            self.log("received '%s' from %s\n" % (str(t), peeraddr))
         if t['mtype'] is CONFIG['MCAST_FIN']:
+            self.log("feedback: {0} from {1}\n".format(self.suppressor.stats(peeraddr), peeraddr))
             return
 
         t['mtype'] = CONFIG['MCAST_NORMAL']
         #del t['payload']
         del t['payload_size']
-        feedback = pack_mcastpkt(**t)
-        if t['nrate'] < t['crate'] or t['crate'] < t['nrate'] and (0 == t['crate'] or self.last_rate <= t['crate']):
+        triggered = t['nrate'] < t['crate'] or t['crate'] < t['nrate'] and (0 == t['crate'] or self.last_rate <= t['crate'])
+        nrate = self.suppressor.check(peeraddr, t['crate'], t['nrate'], triggered, time.time())
+        if nrate is not None:
+            t['nrate'] = nrate
             feedback = pack_mcastpkt(**t)
-            self.log("feedback is sent\n")
+            if self.rx_log is not None:
+                self.rx_log.record(mcast_log.EVENT_FEEDBACK, remote=peeraddr, **t)
+            else:
+                self.log("feedback is sent\n")
             self.echo_sock.sendto(feedback, peeraddr)
 
-    def loop(self):
-        if self.multicast_group == 0 or self.multicast_group == '0.0.0.0':
+    def loop_sniff(self):
+        if self.is_wildcard():
             filter = 'udp and port {1}'.format(self.multicast_group, self.listen_port)
         else:
             filter = 'dst {0} and udp and port {1}'.format(self.multicast_group, self.listen_port)
-        
+        sniff(filter=filter, prn=self.pkt_callback, store=0)
+
+    def loop_udp(self):
+        if self.is_wildcard():
+            raise ValueError("The udp backend has to join a multicast group, use the packet backend for 0.0.0.0")
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', self.listen_port))
+        mreq = struct.pack('4s4s', socket.inet_aton(self.multicast_group), socket.inet_aton('0.0.0.0'))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        while True:
+            data, peeraddr = sock.recvfrom(70000)
+            self.handle(data, peeraddr)
+
+    def loop_packet(self):
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_IP))
+        group = None if self.is_wildcard() else self.multicast_group
+        self.bpf_prog = attach_filter(sock, udp_filter(self.listen_port, group))
+        while True:
+            frame, addr = sock.recvfrom(70000)
+            if addr[2] == PACKET_OUTGOING:
+                continue
+            parsed = parse_udp_frame(frame)
+            if parsed is not None:
+                self.handle(*parsed)
+
+    def loop(self):
         try:
-            sniff(filter=filter, prn=self.pkt_callback, store=0)
+            getattr(self, 'loop_' + self.backend)()
         except KeyboardInterrupt:
             print('Interrupted')
+            self.stop()
             sys.exit(0)
         
     def start(self):
         return self.loop()
     
     def stop(self):
-        pass
+        self.log("feedback: {0}\n".format(self.suppressor.stats()))
+        if self.recorder is not None:
+            self.recorder.close()
 
 
 class sender(object):
@@ -126,6 +287,9 @@ class sender(object):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         ttl = struct.pack('b', 1)
         self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        # pick the source port now: it names the flow (flow_id, log files)
+        # and the switch's flow hash, and sendto() would only bind it later
+        self.sock.bind(('', 0))
         self.keep_sending = True
         self.sock.settimeout(0.1)
 
@@ -135,8 +299,26 @@ class sender(object):
         self.flow_size = params.get('flow_size', CONFIG['payload_size'] * self.pktnum)
         self.flow_remaining_size = self.flow_size
         #self.desired_prio = 0
-        self.measured_rates = {}
+        # aggregates the nrate reported by every receiver, see mcast_rates
+        self.measured_rates = make_tracker(
+            params.get('rate_policy', 'min'),
+            timeout=params.get('rate_timeout', 0),
+            percentile=params.get('rate_percentile', 10),
+            alpha=params.get('rate_alpha', .3))
+        # set by the first feedback, wakes up send_probe()
+        self.rate_ready = threading.Event()
+        self.probe_latency = None
         self.receiver_num = params.get('receiver_num', 2)
+        self.packer = packer()
+
+        # burst > 1 sends that many paced packets per sendmmsg() call
+        self.burst = params.get('burst', 1)
+        self.batch = None
+        if self.burst > 1:
+            self.batch = batch_sender(self.sock, (self.multicast_group, self.listen_port),
+                                      [packer() for i in range(self.burst)])
+        self.feedback = batch_receiver(self.sock)
+        self.pacer = make_pacer(params.get('pacer', 'sleep'))
         
         self.policy = params.get('policy', 'pam')
         self.fs = True if self.policy == 'fs' else False
@@ -151,10 +333,22 @@ class sender(object):
             self.get_desired_prio = lambda: int(self.flow_remaining_size / CONFIG['payload_size'])
 
         self.logfile = None
-        threading.Thread(target=self.listen).start()
+        self.recorder = self.tx_log = self.rx_log = None
+        # without the listen thread the caller has to feed on_feedback()
+        self.listener = None
+        if params.get('threaded', True):
+            self.listener = threading.Thread(target=self.listen)
+            self.listener.start()
         
         self.flow_id = '{0}_{1}_{2}_{3}'.format(self.sock.getsockname()[0], self.sock.getsockname()[1], self.multicast_group, self.listen_port)
+        self.flow_addr = dict(local=self.sock.getsockname(), remote=(self.multicast_group, self.listen_port))
         self.logfile = open(self.flow_id + '.log', 'w')
+        # log_format='binary' keeps per-packet records in mcast_log rings,
+        # one per thread, instead of writing text lines
+        if params.get('log_format', 'text') == 'binary':
+            self.recorder = mcast_log.recorder(self.flow_id + '.bin', sample=params.get('log_sample', 1))
+            self.tx_log = self.recorder.ring()
+            self.rx_log = self.recorder.ring()
 
     def get_left_time(self):
         t = self.deadline + self.start_time - time.time()
@@ -185,29 +379,70 @@ class sender(object):
         sys.stdout.write(msg)
         
     def listen(self):
+        # blocks until feedback arrives or close() interrupts it
         while self.keep_sending:
             try:
-                payload, peeraddr = self.sock.recvfrom(70000)
-                t = unpack_mcastpkt(payload)
-                self.log("get:  '%s' from %s  \n" % (str(t), peeraddr))
-                # update sending rate
-                self.measured_rates[peeraddr] = t['nrate']
-                if len(self.measured_rates) >= self.receiver_num:
-                    self.sending_rate = min(self.measured_rates.values())
-
+                # with a rate_timeout, wake up to expire silent receivers
+                for payload, peeraddr in self.feedback.recv(self.measured_rates.timeout or None):
+                    self.on_feedback(payload, peeraddr)
             except socket.timeout:
-                continue
+                self.expire_rates()
+
+    def on_feedback(self, payload, peeraddr):
+        t = unpack_mcastpkt(payload)
+        if self.rx_log is not None:
+            self.rx_log.record(mcast_log.EVENT_GET, t['mtype'], t['prio'], t['crate'], t['nrate'], t['payload_size'],
+                               local=self.flow_addr['local'], remote=peeraddr)
+        else:
+            self.log("get:  '%s' from %s  \n" % (str(t), peeraddr))
+        # update sending rate
+        self.publish_rate(self.measured_rates.update(peeraddr, t['nrate']))
+
+    def expire_rates(self):
+        "Drop receivers silent for longer than rate_timeout and follow the others"
+        if self.measured_rates.expire():
+            self.publish_rate(self.measured_rates.value())
+
+    def publish_rate(self, rate):
+        # the first rate waits for every receiver; once sending, expired
+        # receivers no longer count and without any the flow probes again
+        if len(self.measured_rates) >= self.receiver_num or self.sending_rate > 0:
+            self.sending_rate = rate
+            if self.sending_rate > 0:
+                self.rate_ready.set()
+            else:
+                self.rate_ready.clear()
 
     def send(self, msg):
         return self.sock.sendto(msg, (self.multicast_group, self.listen_port))
 
     def send_probe(self):
+        t = time.time()
+        while self.sending_rate <= 0 and self.keep_sending:
+            self.probe_once()
+            self.rate_ready.wait(CONFIG['probe_interval'])
+        if self.sending_rate > 0:
+            self.probe_done(t)
+
+    def probe_done(self, t):
+        "Called when the rate is known and data can go out, t is the first probe"
+        self.probe_latency = time.time() - t
+        self.log("probe-to-first-data latency (s): {0}, flowid='{1}'\n".format(self.probe_latency, self.flow_id))
+
+    def probe_once(self):
         mtype = CONFIG['MCAST_FS'] if self.fs else CONFIG['MCAST_PROBE']
-        while self.sending_rate <= 0:
-            pkt = pack_mcastpkt(
-                mtype=mtype,
-                prio=self.get_desired_prio(),
-                nrate=CONFIG['max_sending_rate'])
+        prio = self.get_desired_prio()
+        # past the deadline get_desired_prio() has just sent the FIN
+        if not self.keep_sending:
+            return
+        pkt = self.packer.pack(
+            mtype=mtype,
+            prio=prio,
+            nrate=CONFIG['max_sending_rate'])
+        if self.tx_log is not None:
+            self.tx_log.record(mcast_log.EVENT_PROBE, mtype, prio, self.sending_rate, CONFIG['max_sending_rate'],
+                               **self.flow_addr)
+        else:
             log_msg = "sent: dict(mtype={0}, prio={1}, crate={2}, nrate={3}, flowid='{4}')\n".format(
                 mtype,
                 self.get_desired_prio(),
@@ -215,47 +450,82 @@ class sender(object):
                 CONFIG['max_sending_rate'],
                 self.flow_id)
             self.log(log_msg)
-            self.send(pkt)
-            time.sleep(CONFIG['probe_interval'])
-        
+        self.send(pkt)
+
+    def next_data_pkt(self, packer):
+        payload_size = min(CONFIG['payload_size'], self.flow_remaining_size)
+        mtype = CONFIG['MCAST_FS'] if self.fs else CONFIG['MCAST_NORMAL']
+        prio = self.get_desired_prio()
+        pkt = packer.pack(
+            mtype=mtype,
+            prio=prio, 
+            crate=self.sending_rate,
+            nrate=CONFIG['max_sending_rate'],
+            payload_size=payload_size,
+        )
+        if self.tx_log is not None:
+            self.tx_log.record(mcast_log.EVENT_SENT, mtype, prio, self.sending_rate, CONFIG['max_sending_rate'],
+                               payload_size, **self.flow_addr)
+            return pkt
+        log_msg = "sent: dict(mtype={0}, prio={1}, crate={2}, nrate={3}, payload_size={4}, flowid='{5}')\n".format(
+            mtype,
+            self.get_desired_prio(),
+            self.sending_rate,
+            CONFIG['max_sending_rate'],
+            payload_size,
+            self.flow_id)
+        self.log(log_msg)
+        return pkt
+
+    def send_burst(self):
+        pkts = []
+        for p in self.batch.packers:
+            pkt = self.next_data_pkt(p)
+            pkts.append(pkt)
+            self.flow_remaining_size -= len(pkt)
+            if self.flow_remaining_size <= 0:
+                break
+        return self.batch.send(pkts)
 
     def send_data(self):
         while self.keep_sending:
             if self.sending_rate <= 0:
                 self.send_probe()
-            t1 = time.time()
-            payload_size = min(CONFIG['payload_size'], self.flow_remaining_size)
-            mtype = CONFIG['MCAST_FS'] if self.fs else CONFIG['MCAST_NORMAL']
-            pkt = pack_mcastpkt(
-                mtype=mtype,
-                prio=self.get_desired_prio(), 
-                crate=self.sending_rate,
-                nrate=CONFIG['max_sending_rate'],
-                payload_size=payload_size,
-            )
-            log_msg = "sent: dict(mtype={0}, prio={1}, crate={2}, nrate={3}, payload_size={4}, flowid='{5}')\n".format(
-                mtype,
-                self.get_desired_prio(),
-                self.sending_rate,
-                CONFIG['max_sending_rate'],
-                payload_size,
-                self.flow_id)
-            self.log(log_msg)
-            n = self.send(pkt)
-            self.flow_remaining_size -= n
-            t = time.time() - t1
-            next_time = (n + CONFIG['mheader_size']) * 8. / self.sending_rate
-            if next_time > t:
-                time.sleep(next_time - t)
+                continue
+            if self.batch is None:
+                n = self.send(self.next_data_pkt(self.packer))
+                self.flow_remaining_size -= n
+                sent = [n]
+            else:
+                sent = self.send_burst()
+            self.pacer.pace(sum(n + CONFIG['mheader_size'] for n in sent) * 8, self.sending_rate)
 
             if self.flow_remaining_size <= 0:
-                pkt = pack_mcastpkt(mtype=CONFIG['MCAST_FIN'])
-                self.send(pkt)
-                self.log("flow completion time (s): {0}\n".format(time.time() - self.start_time))
+                self.send_fin()
                 time.sleep(1)
                 self.keep_sending = 0
                 break
+        self.close()
+
+    def send_fin(self):
+        pkt = pack_mcastpkt(mtype=CONFIG['MCAST_FIN'])
+        self.send(pkt)
+        self.log("flow completion time (s): {0}\n".format(time.time() - self.start_time))
+        self.log("pacing: {0}, flowid='{1}'\n".format(self.pacer.stats(), self.flow_id))
+
+    def close(self):
+        self.keep_sending = 0
+        self.feedback.interrupt()
+        if self.listener is not None and self.listener is not threading.current_thread():
+            self.listener.join()
+        # the listen thread is out of recv(), the sockets can go
+        self.feedback.close()
+        self.sock.close()
         self.log('sender done!\n')
+        if self.recorder is not None:
+            self.recorder.close()
+            if self.recorder.dropped():
+                self.log("# {0} log records dropped\n".format(self.recorder.dropped()))
         if self.logfile is not None:
             self.logfile.close()
             self.logfile = None
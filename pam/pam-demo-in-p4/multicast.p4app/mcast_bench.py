@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for the mcast sender/receiver hot paths.
+
+    ./mcast_bench.py codec --count 100000
+    ./mcast_bench.py receiver --count 20000
+    ./mcast_bench.py io --count 100000 --burst 16
+    ./mcast_bench.py probe --count 20 --delay 0.03
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import socket
+import struct
+import threading
+import time
+
+import mcast
+import mcast_mmsg
+from mcast import CONFIG
+
+
+def timeit(func, count):
+    t1 = time.time()
+    for i in range(count):
+        func(i)
+    return count / (time.time() - t1)
+
+
+def report(name, pps, base=None):
+    if base is None:
+        print("{0:<24} {1:>12.0f} pkt/s".format(name, pps))
+    else:
+        print("{0:<24} {1:>12.0f} pkt/s  x{2:.1f}".format(name, pps, pps / base))
+
+
+def bench_codec(args):
+    # scapy is only needed here and by the sniff backend, not by io/probe
+    from mcast import McastPkt
+
+    def scapy_pack(mtype=0, prio=0, crate=0, nrate=0, payload_size=0):
+        header = McastPkt(mtype=mtype, prio=prio, crate=crate, nrate=nrate)
+        return bytes(header) + bytearray(payload_size)
+
+    def scapy_unpack(data):
+        header = McastPkt(data[:McastPkt.size])
+        payload = data[McastPkt.size:]
+        return dict(mtype=header.mtype, prio=header.prio, crate=header.crate, nrate=header.nrate,
+                    payload=payload, payload_size=len(payload))
+
+    fields = dict(mtype=CONFIG['MCAST_NORMAL'], prio=7, crate=123456, nrate=CONFIG['max_sending_rate'])
+    payload_size = args.payload_size
+
+    # the fast paths must stay byte-identical to the scapy wire format
+    ref = scapy_pack(payload_size=payload_size, **fields)
+    p = mcast.packer(payload_size)
+    assert bytes(mcast.pack_mcastpkt(payload_size=payload_size, **fields)) == bytes(ref)
+    assert bytes(p.pack(payload_size=payload_size, **fields)) == bytes(ref)
+    t = mcast.unpack_mcastpkt(ref)
+    assert scapy_unpack(ref) == t
+
+    print("# pack, payload_size={0}".format(payload_size))
+    base = timeit(lambda i: scapy_pack(payload_size=payload_size, **dict(fields, prio=i & 0xff)), args.count)
+    report("scapy McastPkt", base)
+    report("pack_mcastpkt", timeit(lambda i: mcast.pack_mcastpkt(payload_size=payload_size, **dict(fields, prio=i & 0xff)), args.count), base)
+    report("packer.pack", timeit(lambda i: p.pack(payload_size=payload_size, **dict(fields, prio=i & 0xff)), args.count), base)
+
+    print("# unpack")
+    base = timeit(lambda i: scapy_unpack(ref), args.count)
+    report("scapy McastPkt", base)
+    report("unpack_mcastpkt", timeit(lambda i: mcast.unpack_mcastpkt(ref), args.count), base)
+
+
+def udp_frame(src, dst, sport, dport, payload):
+    """Ethernet/IPv4/UDP frame as seen by the receiver backends."""
+    udp = struct.pack('!HHHH', sport, dport, 8 + len(payload), 0)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(udp) + len(payload), 0, 0, 64, socket.IPPROTO_UDP, 0,
+                     socket.inet_aton(src), socket.inet_aton(dst))
+    eth = struct.pack('!6s6sH', b'\x01\x00\x5e\x01\x02\x03', b'\x00\x00\x00\x00\x00\x01', 0x0800)
+    return eth + ip + udp + bytes(payload)
+
+
+def bench_receiver(args):
+    """
+    Per-packet cost of the sniff backend (scapy dissection + pkt_callback)
+    against the raw backends (parse_udp_frame + handle), on the same frames.
+    Every other frame triggers a feedback to an unused port on 127.0.0.1.
+    """
+    from scapy.all import Ether
+
+    frames = []
+    for i in range(64):
+        nrate = CONFIG['max_sending_rate'] // 2 if i % 2 else CONFIG['max_sending_rate']
+        payload = mcast.pack_mcastpkt(mtype=CONFIG['MCAST_NORMAL'], prio=i, crate=CONFIG['max_sending_rate'],
+                                      nrate=nrate, payload_size=args.payload_size)
+        frames.append(udp_frame('127.0.0.1', '224.1.2.3', 40000 + i, 1234, payload))
+
+    r = mcast.receiver(multicast_group='224.1.2.3', listen_port=1234)
+    r.log = lambda msg="", level=1: None
+
+    def sniff_path(i):
+        r.pkt_callback(Ether(frames[i & 63]))
+
+    def raw_path(i):
+        r.handle(*mcast.parse_udp_frame(frames[i & 63]))
+
+    print("# receiver, payload_size={0}".format(args.payload_size))
+    base = timeit(sniff_path, args.count)
+    report("sniff (scapy)", base)
+    report("udp/packet (raw)", timeit(raw_path, args.count), base)
+
+
+def bench_io(args):
+    """
+    Packets/s of one sendto() per packet against sendmmsg() bursts, sent
+    to a local sink socket that is drained in between.
+    """
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sink.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    rx = mcast_mmsg.batch_receiver(sink, batch_size=args.burst)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(1)
+    addr = sink.getsockname()
+
+    def drain():
+        try:
+            while rx.recv(0):
+                pass
+        except socket.timeout:
+            pass
+
+    p = mcast.packer(args.payload_size)
+    batch = mcast_mmsg.batch_sender(sock, addr, [mcast.packer(args.payload_size) for i in range(args.burst)])
+    bursts = args.count // args.burst
+
+    def single(i):
+        for j in range(args.burst):
+            sock.sendto(p.pack(mtype=CONFIG['MCAST_NORMAL'], prio=j, payload_size=args.payload_size), addr)
+        drain()
+
+    def burst(i):
+        batch.send([q.pack(mtype=CONFIG['MCAST_NORMAL'], prio=j, payload_size=args.payload_size)
+                    for j, q in enumerate(batch.packers)])
+        drain()
+
+    print("# io, burst={0}, sendmmsg={1}".format(args.burst, mcast_mmsg.sendmmsg is not None))
+    base = timeit(single, bursts) * args.burst
+    report("sendto", base)
+    report("batch_sender", timeit(burst, bursts) * args.burst, base)
+
+
+def bench_probe(args):
+    """
+    Probe-to-first-data latency of the sender against a local responder
+    that answers every probe after `delay` seconds. With the event handoff
+    the latency should be close to the delay, not a multiple of
+    probe_interval.
+    """
+    echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    echo.bind(('127.0.0.1', 0))
+    echo.settimeout(.5)
+    running = [True]
+
+    def respond():
+        while running[0]:
+            try:
+                data, addr = echo.recvfrom(2048)
+            except socket.timeout:
+                continue
+            t = mcast.unpack_mcastpkt(data)
+            if t['mtype'] == CONFIG['MCAST_PROBE']:
+                threading.Timer(args.delay, echo.sendto, (mcast.pack_mcastpkt(
+                    mtype=CONFIG['MCAST_NORMAL'], prio=t['prio'], nrate=CONFIG['max_sending_rate']), addr)).start()
+
+    responder = threading.Thread(target=respond)
+    responder.start()
+    latencies = []
+    try:
+        for i in range(args.count):
+            s = mcast.sender(multicast_group='127.0.0.1', listen_port=echo.getsockname()[1], receiver_num=1)
+            s.log = lambda msg="", level=1: None
+            s.start_time = time.time()
+            s.send_probe()
+            latencies.append(s.probe_latency)
+            s.close()
+            os.remove(s.flow_id + '.log')
+    finally:
+        running[0] = False
+        responder.join()
+
+    latencies.sort()
+    print("# probe, delay={0}, probe_interval={1}".format(args.delay, CONFIG['probe_interval']))
+    print("{0:<24} {1:>9.6f} s".format("min", latencies[0]))
+    print("{0:<24} {1:>9.6f} s".format("median", latencies[len(latencies) // 2]))
+    print("{0:<24} {1:>9.6f} s".format("max", latencies[-1]))
+
+
+parser = argparse.ArgumentParser(description='mcast micro-benchmarks')
+subparsers = parser.add_subparsers(dest='bench')
+
+codec_parser = subparsers.add_parser('codec', help='scapy vs struct header codec')
+codec_parser.add_argument('--count', type=int, default=100000)
+codec_parser.add_argument('--payload_size', type=int, default=CONFIG['payload_size'])
+codec_parser.set_defaults(func=bench_codec)
+
+receiver_parser = subparsers.add_parser('receiver', help='sniff vs raw socket receiver backends')
+receiver_parser.add_argument('--count', type=int, default=20000)
+receiver_parser.add_argument('--payload_size', type=int, default=CONFIG['payload_size'])
+receiver_parser.set_defaults(func=bench_receiver)
+
+io_parser = subparsers.add_parser('io', help='sendto vs sendmmsg bursts')
+io_parser.add_argument('--count', type=int, default=100000)
+io_parser.add_argument('--burst', type=int, default=16)
+io_parser.add_argument('--payload_size', type=int, default=CONFIG['payload_size'])
+io_parser.set_defaults(func=bench_io)
+
+probe_parser = subparsers.add_parser('probe', help='probe-to-first-data latency of the sender')
+probe_parser.add_argument('--count', type=int, default=20)
+probe_parser.add_argument('--delay', type=float, default=.03,
+                          help='seconds the local responder waits before answering a probe')
+probe_parser.set_defaults(func=bench_probe)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Shift tables for nrate_division.
+
+The switch has no divider: calc_nrate approximates n2rate / division_num
+as (n2rate >> s1) + ... + (n2rate >> s4), and calc_nrate_signed subtracts
+the terms whose bit is set in `neg`. For every division_num i this module
+finds the k-term combination of shifts 0..31 whose sum is closest to 1/i,
+by looking up 1/i in the sorted list of every reachable sum, so the result
+is optimal rather than greedy (dec2bin in mcast.py). By default the sum is
+never above 1/i, so no flow is told more than its fair share.
+
+    ./mcast_division.py --size 10001 --signed > commands_division.txt
+
+The error reported is the exact relative error |sum * i - 1| of the
+coefficient; the switch floors every term on top of that, which moves the
+rate by less than one unit per term (up, for subtracted terms).
+"""
+from __future__ import print_function
+
+import argparse
+import bisect
+import itertools
+import sys
+from fractions import Fraction
+
+MAX_SHIFT = 31
+# sums are integers in units of 2**-MAX_SHIFT
+ONE = 1 << MAX_SHIFT
+# a shift of 32 turns a term off (bit<32> >> 32 is 0)
+NO_TERM = 32
+ACTION_TERMS = 4
+# size of nrate_division in mcast_router.p4, FLOW_NUM + 1
+TABLE_SIZE = 10001
+
+
+class shift_sums(object):
+    """
+    Every sum of up to `terms` distinct power-of-two terms 2**-s (minus the
+    negative ones if signed), sorted, with the fewest-term combination
+    reaching each.
+    """
+    def __init__(self, terms=ACTION_TERMS, signed=False, max_shift=MAX_SHIFT):
+        combos = {}
+        for n in range(1, terms + 1):
+            for shifts in itertools.combinations(range(max_shift + 1), n):
+                parts = [1 << (MAX_SHIFT - s) for s in shifts]
+                # the largest term is never subtracted, the sum would be negative
+                for signs in itertools.product((0, 1), repeat=n - 1) if signed else [(0,) * (n - 1)]:
+                    signs = (0,) + signs
+                    value = sum(-p if neg else p for p, neg in zip(parts, signs))
+                    if value not in combos:
+                        combos[value] = (shifts, signs)
+        self.values = sorted(combos)
+        self.combos = combos
+
+    def best(self, i, under=True):
+        "(shifts, signs, value) of the sum closest to 1/i, not above it if under"
+        target = Fraction(ONE, i)
+        k = bisect.bisect_right(self.values, target)
+        candidates = self.values[max(k - 1, 0):k] if under else self.values[max(k - 1, 0):k + 1]
+        value = min(candidates, key=lambda v: abs(v - target))
+        shifts, signs = self.combos[value]
+        return shifts, signs, value
+
+
+def relative_error(value, i):
+    "Exact |value * i - 1| for a sum in units of 2**-MAX_SHIFT"
+    return abs(Fraction(value, ONE) * i - 1)
+
+
+def command(i, maxrate, shifts, signs):
+    args = list(shifts) + [NO_TERM] * (ACTION_TERMS - len(shifts))
+    neg = sum(1 << k for k, s in enumerate(signs) if s)
+    if neg:
+        return 'table_add nrate_division calc_nrate_signed {0} => {1} {2} {3} {4} {5} {6}'.format(i, maxrate, *(args + [neg]))
+    return 'table_add nrate_division calc_nrate {0} => {1} {2} {3} {4} {5}'.format(i, maxrate, *args)
+
+
+def division_table(size=32, terms=ACTION_TERMS, signed=False, under=True, maxrate=500000):
+    """
+    (commands, errors) for division_num 1..size; errors[i - 1] is the exact
+    relative error of row i.
+    """
+    if not 1 <= terms <= ACTION_TERMS:
+        raise ValueError('calc_nrate takes 1 to {0} terms'.format(ACTION_TERMS))
+    if size > TABLE_SIZE:
+        raise ValueError('nrate_division holds {0} rows, not {1}'.format(TABLE_SIZE, size))
+    sums = shift_sums(terms, signed)
+    commands, errors = [], []
+    for i in range(1, size + 1):
+        shifts, signs, value = sums.best(i, under)
+        commands.append(command(i, maxrate, shifts, signs))
+        errors.append(relative_error(value, i))
+    return commands, errors
+
+
+def table_errors(filename):
+    "{division_num: exact relative error} of the nrate_division rows of a commands file"
+    errors = {}
+    with open(filename) as f:
+        for line in f:
+            words = line.split()
+            if words[:2] != ['table_add', 'nrate_division'] or len(words) < 10:
+                continue
+            i = int(words[3])
+            shifts = [int(w) for w in words[6:10]]
+            neg = int(words[10]) if words[2] == 'calc_nrate_signed' else 0
+            value = sum((-1 if neg >> k & 1 else 1) << (MAX_SHIFT - s)
+                        for k, s in enumerate(shifts) if s < NO_TERM)
+            errors[i] = relative_error(value, i)
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate nrate_division commands')
+    parser.add_argument('--size', type=int, default=32,
+                        help='rows, division_num 1..size, at most {0}'.format(TABLE_SIZE))
+    parser.add_argument('--terms', type=int, default=ACTION_TERMS, help='shift terms per row, 1 to 4')
+    parser.add_argument('--signed', action='store_true', help='allow subtracted terms (calc_nrate_signed)')
+    parser.add_argument('--over', action='store_true', help='allow sums above 1/division_num')
+    parser.add_argument('--maxrate', type=int, default=500000)
+    parser.add_argument('--compare', type=str, default=None, help='commands file to report the errors of')
+    args = parser.parse_args()
+    if args.size > TABLE_SIZE:
+        parser.error('nrate_division holds {0} rows, --size {1} would not fit'.format(TABLE_SIZE, args.size))
+
+    commands, errors = division_table(args.size, args.terms, args.signed, not args.over, args.maxrate)
+    print('\n'.join(commands))
+
+    worst = max(range(len(errors)), key=lambda k: errors[k])
+    sys.stderr.write('max relative error {0:.3g} (division_num {1}), mean {2:.3g}\n'.format(
+        float(errors[worst]), worst + 1, float(sum(errors)) / len(errors)))
+    if args.compare:
+        old = table_errors(args.compare)
+        if old:
+            worst = max(old, key=old.get)
+            sys.stderr.write('{0}: max relative error {1:.3g} (division_num {2}), mean {3:.3g} over {4} rows\n'.format(
+                args.compare, float(old[worst]), worst, float(sum(old.values())) / len(old), len(old)))
+
+
+if __name__ == '__main__':
+    main()
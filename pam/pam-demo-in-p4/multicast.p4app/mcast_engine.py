@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs many mcast sender flows in one process on one asyncio event loop,
+instead of one mcast_sender.py process (and listen thread) per flow.
+
+    ./mcast_engine.py \
+        --flow "--pktnum 120 --multicast_group 224.1.2.2 --start_sleep 2.0 --policy fifo --deadline 3" \
+        --flow "--pktnum 200 --multicast_group 224.1.2.3 --start_sleep 1.0 --policy fifo --deadline 8"
+
+Every --flow takes the arguments of mcast_sender.py. Each flow keeps its
+own socket: receivers echo feedback to the (ip, port) the data came from
+and the feedback header carries no flow id, so the source port is what
+identifies a flow, both here and in the switch's flow hash. All sockets
+are registered with the event loop, which hands feedback to the owning
+flow as soon as it arrives. Needs Python 3.
+"""
+import argparse
+import asyncio
+import shlex
+import socket
+import time
+
+import mcast
+from mcast import CONFIG, pack_mcastpkt
+from mcast_pacer import clock
+import mcast_sender
+
+
+class flow(mcast.sender):
+    """
+    A sender driven by the event loop: probing, pacing and the deadline
+    never block, and the first feedback wakes a probing flow immediately.
+    """
+    def __init__(self, loop, start_sleep=0, **params):
+        mcast.sender.__init__(self, threaded=False, **params)
+        self.loop = loop
+        self.start_sleep = start_sleep
+        # on_feedback() sets it like the threading.Event of the sender
+        self.rate_ready = asyncio.Event()
+        loop.add_reader(self.sock.fileno(), self.read_feedback)
+
+    def read_feedback(self):
+        try:
+            for payload, peeraddr in self.feedback.recv(0):
+                self.on_feedback(payload, peeraddr)
+        except socket.timeout:
+            pass
+
+    def get_left_time(self):
+        t = self.deadline + self.start_time - time.time()
+        if t < 0 and self.keep_sending:
+            self.send(pack_mcastpkt(mtype=CONFIG['MCAST_FIN']))
+            self.log("# missing deadline: {0}\n".format(time.time() - self.start_time))
+            self.keep_sending = 0
+        return max(0, int(20 * t))
+
+    async def probe(self):
+        t = time.time()
+        while self.sending_rate <= 0 and self.keep_sending:
+            self.probe_once()
+            try:
+                await asyncio.wait_for(self.rate_ready.wait(), CONFIG['probe_interval'])
+            except asyncio.TimeoutError:
+                pass
+        if self.sending_rate > 0:
+            self.probe_done(t)
+
+    async def run(self):
+        await asyncio.sleep(self.start_sleep)
+        self.start_time = time.time()
+        while self.keep_sending:
+            self.expire_rates()
+            if self.sending_rate <= 0:
+                await self.probe()
+                continue
+            if self.batch is None:
+                pkt = self.next_data_pkt(self.packer)
+                if not self.keep_sending:
+                    break
+                n = self.send(pkt)
+                self.flow_remaining_size -= n
+                sent = [n]
+            else:
+                sent = self.send_burst()
+            t = self.pacer.due(sum(n + CONFIG['mheader_size'] for n in sent) * 8, self.sending_rate)
+            await asyncio.sleep(max(0., t - clock()))
+            self.pacer.woke(t, clock())
+
+            if self.flow_remaining_size <= 0:
+                self.send_fin()
+                await asyncio.sleep(1)
+                self.keep_sending = 0
+        self.loop.remove_reader(self.sock.fileno())
+        self.close()
+
+
+class engine(object):
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.flows = []
+
+    def add_flow(self, **params):
+        f = flow(self.loop, **params)
+        self.flows.append(f)
+        return f
+
+    async def main(self):
+        await asyncio.gather(*[f.run() for f in self.flows])
+
+    def run(self):
+        try:
+            self.loop.run_until_complete(self.main())
+        finally:
+            self.loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run many mcast sender flows on one event loop.')
+    parser.add_argument('--flow', type=str, action='append', default=[],
+                        help='mcast_sender.py arguments of one flow, can be repeated')
+    args = parser.parse_args()
+
+    e = engine()
+    for s in args.flow:
+        flow_args = mcast_sender.parser.parse_args(shlex.split(s))
+        e.add_flow(start_sleep=flow_args.start_sleep, **mcast_sender.sender_params(flow_args))
+    e.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Feedback suppression for mcast.receiver.
+
+By default a receiver answers every data packet whose nrate differs from
+its crate, so a group of N receivers sends N feedback packets per data
+packet back up the tree. A suppressor keeps per-sender state and holds a
+triggered feedback back:
+
+    threshold -- relative difference between nrate and crate below which
+                 the sender's rate is considered good enough
+    interval  -- minimum time between two feedbacks to the same sender
+    window    -- a feedback is delayed by a random time in [0, window),
+                 like multicast NAK suppression; if data packets show
+                 that the sender already moved to the rate (another
+                 receiver's feedback got there first) it is cancelled
+
+Timers are only checked when a packet from that sender arrives, which is
+often enough since the sender keeps sending while it waits for feedback.
+Probes (crate 0) are always answered at once, the sender cannot start
+before every receiver did.
+"""
+from __future__ import print_function
+
+import random
+
+
+class sender_state(object):
+    __slots__ = ('pending', 'due', 'last_sent', 'triggered', 'sent')
+
+    def __init__(self):
+        self.pending = None
+        self.due = None
+        self.last_sent = None
+        self.triggered = 0
+        self.sent = 0
+
+
+class suppressor(object):
+    def __init__(self, threshold=0, interval=0, window=0, seed=None):
+        self.threshold = threshold
+        self.interval = interval
+        self.window = window
+        self.random = random.Random(seed)
+        self.states = {}
+
+    def state(self, peer):
+        st = self.states.get(peer)
+        if st is None:
+            st = self.states[peer] = sender_state()
+        return st
+
+    def close_enough(self, crate, nrate):
+        return abs(nrate - crate) <= self.threshold * crate
+
+    def check(self, peer, crate, nrate, triggered, now):
+        """
+        Called for every data packet of peer, triggered tells whether it
+        would have been answered without suppression. Returns the rate to
+        send back now, or None.
+        """
+        st = self.state(peer)
+        if triggered:
+            st.triggered += 1
+            if crate == 0:
+                st.pending = st.due = None
+                return self.sent(st, nrate, now)
+            if self.close_enough(crate, nrate):
+                triggered = False
+
+        if not triggered:
+            # the sender got there without us
+            st.pending = st.due = None
+            return None
+
+        st.pending = nrate
+        if st.due is None:
+            st.due = now + self.random.uniform(0, self.window)
+            if st.last_sent is not None:
+                st.due = max(st.due, st.last_sent + self.interval)
+        if now < st.due:
+            return None
+        st.pending = st.due = None
+        return self.sent(st, nrate, now)
+
+    def sent(self, st, nrate, now):
+        st.last_sent = now
+        st.sent += 1
+        return nrate
+
+    def stats(self, peer=None):
+        states = list(self.states.values()) if peer is None else [self.state(peer)]
+        triggered = sum(st.triggered for st in states)
+        sent = sum(st.sent for st in states)
+        return dict(triggered=triggered, sent=sent, saved=triggered - sent)
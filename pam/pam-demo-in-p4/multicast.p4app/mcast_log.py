@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Binary per-packet logging for the mcast sender and receiver.
+
+Every thread that logs owns a ring, a preallocated buffer of fixed-size
+records with a single producer (the thread) and a single consumer (the
+flusher thread of the recorder), so writing a record takes no lock and
+does no I/O. The flusher appends whole ring segments to the log file.
+
+    ./mcast_log.py convert 0.0.0.0_0_224.1.2.3_1234.bin
+    ./mcast_log.py convert --csv h3-receiver.bin
+
+convert prints the records in the text format of sender.log/receiver.log.
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import socket
+import struct
+import sys
+import threading
+import time
+
+# timestamp, event, mtype, prio, crate, nrate, payload_size,
+# local (ip, port), remote (ip, port)
+RECORD = struct.Struct('<dBBBIII4sH4sH')
+
+EVENT_SENT = 1      # sender: data packet
+EVENT_PROBE = 2     # sender: probe packet
+EVENT_GET = 3       # sender: feedback from a receiver
+EVENT_RECEIVED = 4  # receiver: data packet from a sender
+EVENT_FEEDBACK = 5  # receiver: feedback sent back
+
+MAGIC = b'MCLOG1\n'
+
+
+class ring(object):
+    def __init__(self, capacity=1 << 16, sample=1):
+        self.capacity = capacity
+        self.buf = bytearray(capacity * RECORD.size)
+        self.head = 0  # only written by the producer
+        self.tail = 0  # only written by the consumer
+        self.sample = sample
+        self.seen = 0
+        self.dropped = 0
+        self.addrs = {}
+
+    def pack_addr(self, addr):
+        if addr not in self.addrs:
+            self.addrs[addr] = (socket.inet_aton(addr[0]), addr[1])
+        return self.addrs[addr]
+
+    def record(self, event, mtype=0, prio=0, crate=0, nrate=0, payload_size=0,
+               local=('0.0.0.0', 0), remote=('0.0.0.0', 0)):
+        """
+        Keep one record out of every `sample`, none if sample is 0.
+        Records are dropped (and counted) when the ring is full.
+        """
+        self.seen += 1
+        if self.sample == 0 or self.seen % self.sample:
+            return
+        head = self.head
+        if head - self.tail >= self.capacity:
+            self.dropped += 1
+            return
+        RECORD.pack_into(self.buf, (head % self.capacity) * RECORD.size,
+                         time.time(), event, mtype, prio, crate, nrate, payload_size,
+                         *(self.pack_addr(local) + self.pack_addr(remote)))
+        self.head = head + 1
+
+    def drain(self, out):
+        head, tail = self.head, self.tail
+        if head == tail:
+            return 0
+        i, j = (tail % self.capacity) * RECORD.size, (head % self.capacity) * RECORD.size
+        if i < j:
+            out.write(self.buf[i:j])
+        else:
+            out.write(self.buf[i:])
+            out.write(self.buf[:j])
+        self.tail = head
+        return head - tail
+
+
+class recorder(object):
+    """
+    Owns the log file and a background thread that flushes all rings to it
+    every flush_interval seconds.
+    """
+    def __init__(self, filename, sample=1, capacity=1 << 16, flush_interval=.5):
+        self.filename = filename
+        self.sample = sample
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.rings = []
+        self.lock = threading.Lock()
+        self.out = io.open(filename, 'wb')
+        self.out.write(MAGIC)
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_loop)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def ring(self):
+        r = ring(self.capacity, self.sample)
+        with self.lock:
+            self.rings.append(r)
+        return r
+
+    def flush(self):
+        with self.lock:
+            for r in self.rings:
+                r.drain(self.out)
+            self.out.flush()
+
+    def flush_loop(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def dropped(self):
+        return sum(r.dropped for r in self.rings)
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.flusher.join()
+        self.flush()
+        self.out.close()
+
+
+def read_records(filename):
+    with io.open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not an mcast binary log: " + filename)
+        data = f.read()
+    records = [RECORD.unpack_from(data, i) for i in range(0, len(data) - RECORD.size + 1, RECORD.size)]
+    # rings of different threads are flushed one after another
+    records.sort(key=lambda r: r[0])
+    return records
+
+
+def format_record(r):
+    ts, event, mtype, prio, crate, nrate, payload_size = r[:7]
+    local = (socket.inet_ntoa(r[7]), r[8])
+    remote = (socket.inet_ntoa(r[9]), r[10])
+    flow_id = '{0}_{1}_{2}_{3}'.format(local[0], local[1], remote[0], remote[1])
+
+    if event == EVENT_SENT:
+        msg = "sent: dict(mtype={0}, prio={1}, crate={2}, nrate={3}, payload_size={4}, flowid='{5}')\n".format(
+            mtype, prio, crate, nrate, payload_size, flow_id)
+    elif event == EVENT_PROBE:
+        msg = "sent: dict(mtype={0}, prio={1}, crate={2}, nrate={3}, flowid='{4}')\n".format(
+            mtype, prio, crate, nrate, flow_id)
+    elif event == EVENT_GET:
+        t = dict(mtype=mtype, prio=prio, crate=crate, nrate=nrate, payload=bytes(bytearray(payload_size)), payload_size=payload_size)
+        msg = "get:  '%s' from %s  \n" % (str(t), remote)
+    elif event == EVENT_RECEIVED:
+        t = dict(mtype=mtype, prio=prio, crate=crate, nrate=nrate, payload_size=payload_size)
+        msg = "received '%s' from %s\n" % (str(t), remote)
+    elif event == EVENT_FEEDBACK:
+        msg = "feedback is sent\n"
+    else:
+        raise ValueError("Unknown event: " + str(event))
+    return "{0:.6f}, {1}".format(ts, msg)
+
+
+def convert(filename, out=sys.stdout, csv=False):
+    if csv:
+        out.write("timestamp,event,mtype,prio,crate,nrate,payload_size,local_ip,local_port,remote_ip,remote_port\n")
+    for r in read_records(filename):
+        if csv:
+            out.write("{0:.6f},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10}\n".format(
+                r[0], r[1], r[2], r[3], r[4], r[5], r[6], socket.inet_ntoa(r[7]), r[8], socket.inet_ntoa(r[9]), r[10]))
+        else:
+            out.write(format_record(r))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='mcast binary log tools')
+    subparsers = parser.add_subparsers(dest='cmd')
+    convert_parser = subparsers.add_parser('convert', help='print a binary log as text')
+    convert_parser.add_argument('filename', type=str)
+    convert_parser.add_argument('--csv', action='store_true', default=False)
+    args = parser.parse_args()
+
+    if args.cmd == 'convert':
+        convert(args.filename, csv=args.csv)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Batched datagram I/O for the mcast sender.
+
+On Linux a burst of packets goes out with one sendmmsg(2) call and all
+queued feedback is drained with one recvmmsg(2) call, both through ctypes.
+Elsewhere the same classes fall back to a sendto/recvfrom loop.
+"""
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import struct
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t)]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ('sin_family', ctypes.c_ushort),
+        ('sin_port', ctypes.c_uint8 * 2),
+        ('sin_addr', ctypes.c_uint8 * 4),
+        ('sin_zero', ctypes.c_uint8 * 8)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint)]
+
+
+def load_mmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sendmmsg, recvmmsg = libc.sendmmsg, libc.recvmmsg
+    except (OSError, AttributeError):
+        return None, None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    return sendmmsg, recvmmsg
+
+sendmmsg, recvmmsg = load_mmsg()
+
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0x40)
+
+
+def to_sockaddr(addr, name=None):
+    if name is None:
+        name = sockaddr_in()
+    name.sin_family = socket.AF_INET
+    name.sin_port[:] = bytearray(struct.pack('!H', addr[1]))
+    name.sin_addr[:] = bytearray(socket.inet_aton(socket.gethostbyname(addr[0])))
+    return name
+
+
+def from_sockaddr(name):
+    return socket.inet_ntoa(bytes(bytearray(name.sin_addr))), (name.sin_port[0] << 8) | name.sin_port[1]
+
+
+def raise_errno(err):
+    raise socket.error(err, os.strerror(err))
+
+
+class batch_sender(object):
+    """
+    Sends bursts of up to len(packers) packets to addr with one syscall.
+
+    The i-th packet of a burst has to be packed with packers[i] (see
+    mcast.packer), since their buffers are what the preallocated iovecs
+    point to.
+    """
+    def __init__(self, sock, addr, packers):
+        self.sock = sock
+        self.addr = addr
+        self.packers = packers
+        batch_size = len(packers)
+
+        self.msgs = None
+        if sendmmsg is None:
+            return
+        self.name = to_sockaddr(addr)
+        self.iov = (iovec * batch_size)()
+        self.msgs = (mmsghdr * batch_size)()
+        self.bufs = [None] * batch_size
+        for i in range(batch_size):
+            self.bind(i)
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.name)
+            hdr.msg_namelen = ctypes.sizeof(self.name)
+            hdr.msg_iov = ctypes.pointer(self.iov[i])
+            hdr.msg_iovlen = 1
+
+    def bind(self, i):
+        "Point the i-th iovec at the current buffer of packers[i]"
+        buf = self.packers[i].buf
+        self.bufs[i] = (buf, (ctypes.c_char * len(buf)).from_buffer(buf))
+        self.iov[i].iov_base = ctypes.addressof(self.bufs[i][1])
+
+    def send(self, pkts):
+        "Send pkts, returns the number of bytes sent for every packet"
+        if self.msgs is None:
+            return [self.sock.sendto(pkt, self.addr) for pkt in pkts]
+
+        for i, pkt in enumerate(pkts):
+            # packer.pack() reallocates its buffer for larger payloads
+            if self.bufs[i][0] is not self.packers[i].buf:
+                self.bind(i)
+            self.iov[i].iov_len = len(pkt)
+        fd = self.sock.fileno()
+        sent = 0
+        while sent < len(pkts):
+            n = sendmmsg(fd, ctypes.byref(self.msgs, sent * ctypes.sizeof(mmsghdr)), len(pkts) - sent, 0)
+            if n >= 0:
+                sent += n
+                continue
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise_errno(err)
+            # socket timeouts make the fd non-blocking, wait like sendto() would
+            _, w, _ = select.select([], [self.sock], [], self.sock.gettimeout())
+            if not w:
+                raise socket.timeout('timed out')
+        return [self.msgs[i].msg_len for i in range(len(pkts))]
+
+
+class batch_receiver(object):
+    """
+    Drains up to batch_size queued datagrams of sock with one syscall.
+
+    A thread blocked in recv() can be woken from another one with
+    interrupt(), so it does not have to poll with a short timeout.
+    """
+    def __init__(self, sock, batch_size=64, bufsize=2048):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.bufsize = bufsize
+        self.waker, self.wakeup = socket.socketpair()
+        self.wakeup.setblocking(False)
+
+        self.msgs = None
+        if recvmmsg is None:
+            return
+        self.names = (sockaddr_in * batch_size)()
+        self.iov = (iovec * batch_size)()
+        self.msgs = (mmsghdr * batch_size)()
+        self.bufs = [ctypes.create_string_buffer(bufsize) for i in range(batch_size)]
+        for i in range(batch_size):
+            self.iov[i].iov_base = ctypes.addressof(self.bufs[i])
+            self.iov[i].iov_len = bufsize
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.names[i])
+            hdr.msg_iov = ctypes.pointer(self.iov[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self, timeout=None):
+        """
+        Wait up to timeout seconds for a datagram, then return all queued
+        ones as a list of (data, peeraddr). Raises socket.timeout, returns
+        an empty list after interrupt().
+        """
+        r, _, _ = select.select([self.sock, self.wakeup], [], [], timeout)
+        if not r:
+            raise socket.timeout('timed out')
+        if self.wakeup in r:
+            try:
+                self.wakeup.recv(64)
+            except socket.error:
+                pass
+            return []
+
+        if self.msgs is None:
+            ret = [self.sock.recvfrom(self.bufsize)]
+            while len(ret) < self.batch_size and select.select([self.sock], [], [], 0)[0]:
+                ret.append(self.sock.recvfrom(self.bufsize))
+            return ret
+
+        for i in range(self.batch_size):
+            self.msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+        n = recvmmsg(self.sock.fileno(), self.msgs, self.batch_size, MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise_errno(err)
+        return [(self.bufs[i].raw[:self.msgs[i].msg_len], from_sockaddr(self.names[i])) for i in range(n)]
+
+    def interrupt(self):
+        "Wake up a recv() blocked in another thread"
+        try:
+            self.waker.send(b'x')
+        except socket.error:
+            pass
+
+    def close(self):
+        self.waker.close()
+        self.wakeup.close()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Pacers for mcast.sender.send_data.
+
+After every packet (or burst) the sender calls pacer.pace(nbits, rate),
+which blocks until the next send is due; event-loop callers use due() and
+woke() instead and do the waiting themselves. Pacers differ in how they
+pick that time:
+
+    sleep       -- the next send is due nbits/rate after the previous one
+                   actually went out; sleep() overshoot accumulates
+    hybrid      -- same schedule, but the last `spin` seconds of every wait
+                   are busy-waited to beat the timer granularity
+    tokenbucket -- a token bucket of `bucket` bits refilled at rate
+    deadline    -- absolute send times: each deadline is the previous
+                   deadline plus nbits/rate, so wake-up errors do not
+                   accumulate; falls back to now after `max_lag` seconds
+
+Every pacer records achieved against target rate, see pacer.stats().
+"""
+from __future__ import print_function
+
+import time
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class pacer(object):
+    def __init__(self, spin=0, **params):
+        self.spin = spin
+
+        self.last = None
+        self.end = None
+        self.pending = None
+        self.count = 0
+        self.bits = 0
+        self.ideal_time = 0.
+        self.elapsed = 0.
+        self.lateness = 0.
+        self.max_lateness = 0.
+
+    def schedule(self, nbits, rate, now):
+        "Absolute time at which the next send is due"
+        return self.last + float(nbits) / rate
+
+    def wait_until(self, t):
+        remaining = t - clock()
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        while clock() < t:
+            pass
+        return clock()
+
+    def pace(self, nbits, rate):
+        t = self.due(nbits, rate)
+        now = clock()
+        self.woke(t, self.wait_until(t) if t > now else now)
+
+    def due(self, nbits, rate):
+        "Like pace(), but only returns the due time; call woke() once there"
+        now = clock()
+        if self.last is None:
+            self.last = now
+        self.pending = (nbits, rate)
+        return self.schedule(nbits, rate, now)
+
+    def woke(self, t, end):
+        if self.pending is None:
+            raise RuntimeError('pacer.woke() without a due() to wake from')
+        nbits, rate = self.pending
+        self.pending = None
+        # the first call has no previous send to measure from
+        if self.count > 0:
+            self.bits += nbits
+            self.ideal_time += float(nbits) / rate
+            self.elapsed += end - self.end
+            late = end - t if end > t else 0.
+            self.lateness += late
+            self.max_lateness = max(self.max_lateness, late)
+        self.count += 1
+        self.end = end
+        self.advance(t, end)
+
+    def advance(self, t, end):
+        self.last = end
+
+    def stats(self):
+        n = max(self.count - 1, 1)
+        target = self.bits / self.ideal_time if self.ideal_time > 0 else 0
+        achieved = self.bits / self.elapsed if self.elapsed > 0 else 0
+        return dict(
+            pacer=self.name,
+            packets=self.count,
+            target_rate=int(target),
+            achieved_rate=int(achieved),
+            ratio=round(achieved / target, 4) if target > 0 else 0,
+            mean_lateness=self.lateness / n,
+            max_lateness=self.max_lateness)
+
+
+class sleep_pacer(pacer):
+    name = 'sleep'
+
+
+class hybrid_pacer(sleep_pacer):
+    name = 'hybrid'
+
+    def __init__(self, spin=.002, **params):
+        sleep_pacer.__init__(self, spin=spin, **params)
+
+
+class token_bucket_pacer(pacer):
+    name = 'tokenbucket'
+
+    def __init__(self, bucket=4 * 8 * 1052, spin=.002, **params):
+        pacer.__init__(self, spin=spin, **params)
+        self.bucket = bucket
+        self.tokens = bucket
+        self.refilled = None
+
+    def schedule(self, nbits, rate, now):
+        if self.refilled is not None:
+            self.tokens = min(self.bucket, self.tokens + (now - self.refilled) * rate)
+        self.refilled = now
+        self.tokens -= nbits
+        if self.tokens >= 0:
+            return now
+        return now - self.tokens / float(rate)
+
+
+class deadline_pacer(pacer):
+    name = 'deadline'
+
+    def __init__(self, max_lag=.005, spin=.002, **params):
+        pacer.__init__(self, spin=spin, **params)
+        self.max_lag = max_lag
+
+    def schedule(self, nbits, rate, now):
+        t = self.last + float(nbits) / rate
+        if now - t > self.max_lag:
+            # too far behind (e.g. after probing), don't burst to catch up
+            t = now
+        return t
+
+    def advance(self, t, end):
+        self.last = t
+
+
+PACERS = dict((p.name, p) for p in (sleep_pacer, hybrid_pacer, token_bucket_pacer, deadline_pacer))
+
+
+def make_pacer(name='sleep', **params):
+    if name not in PACERS:
+        raise ValueError("Unknown pacer: " + str(name))
+    return PACERS[name](**params)
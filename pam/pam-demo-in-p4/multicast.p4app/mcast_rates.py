@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Aggregation of the per-receiver rates in the feedback of a multicast flow.
+
+mcast.sender feeds every (receiver, nrate) pair to a tracker, which keeps
+the aggregate the flow sends at up to date without rescanning all
+receivers:
+
+    min         -- the bottleneck rate, a heap with lazy deletion
+    percentile  -- the q-th percentile, a sorted list kept with bisect, so a
+                   few slow receivers can be outvoted
+    ewma        -- the minimum of per-receiver exponentially weighted
+                   moving averages, smoothing out single low reports
+
+Receivers that did not report for `timeout` seconds are dropped (0 keeps
+them forever); the least recently updated receiver is always the first
+one of an OrderedDict, so expiring is amortized O(1) as well.
+"""
+from __future__ import print_function
+
+import bisect
+import heapq
+import time
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+
+
+class tracker(ABCMeta('tracker_base', (object,), {})):
+    def __init__(self, timeout=0, **params):
+        self.timeout = timeout
+        self.updated = OrderedDict()  # peer -> last update, oldest first
+
+    def __len__(self):
+        return len(self.updated)
+
+    def update(self, peer, rate, now=None):
+        "Record rate for peer and return the aggregate"
+        if now is None:
+            now = time.time()
+        # re-insert so peer moves to the end (no move_to_end in python 2)
+        self.updated.pop(peer, None)
+        self.updated[peer] = now
+        self.set(peer, rate)
+        self.expire(now)
+        return self.value()
+
+    def expire(self, now=None):
+        "Drop the receivers that did not report for timeout seconds, returns how many"
+        if not self.timeout:
+            return 0
+        if now is None:
+            now = time.time()
+        dropped = 0
+        while self.updated:
+            peer, t = next(iter(self.updated.items()))
+            if now - t <= self.timeout:
+                break
+            del self.updated[peer]
+            self.remove(peer)
+            dropped += 1
+        return dropped
+
+    @abstractmethod
+    def set(self, peer, rate):
+        "Record the latest rate of peer"
+
+    @abstractmethod
+    def remove(self, peer):
+        "Forget peer"
+
+    @abstractmethod
+    def value(self):
+        "The aggregate rate over all peers, 0 without any"
+
+
+class min_tracker(tracker):
+    name = 'min'
+
+    def __init__(self, **params):
+        tracker.__init__(self, **params)
+        self.heap = []     # [rate, seq, peer], stale entries are skipped
+        self.current = {}  # peer -> (rate, seq) of its valid heap entry
+        self.seq = 0
+
+    def set(self, peer, rate):
+        self.seq += 1
+        self.current[peer] = (rate, self.seq)
+        heapq.heappush(self.heap, (rate, self.seq, peer))
+        if len(self.heap) > 2 * len(self.current) + 64:
+            self.heap = [(r, s, p) for p, (r, s) in self.current.items()]
+            heapq.heapify(self.heap)
+
+    def remove(self, peer):
+        self.current.pop(peer, None)
+
+    def value(self):
+        heap = self.heap
+        while heap:
+            rate, seq, peer = heap[0]
+            if self.current.get(peer, (None, None))[1] == seq:
+                return rate
+            heapq.heappop(heap)
+        return 0
+
+
+class percentile_tracker(tracker):
+    name = 'percentile'
+
+    def __init__(self, percentile=10, **params):
+        tracker.__init__(self, **params)
+        self.percentile = percentile
+        self.rates = {}
+        self.sorted = []  # (rate, peer)
+
+    def set(self, peer, rate):
+        self.remove(peer)
+        self.rates[peer] = rate
+        bisect.insort(self.sorted, (rate, peer))
+
+    def remove(self, peer):
+        if peer not in self.rates:
+            return
+        i = bisect.bisect_left(self.sorted, (self.rates.pop(peer), peer))
+        del self.sorted[i]
+
+    def value(self):
+        if not self.sorted:
+            return 0
+        return self.sorted[int(self.percentile / 100. * (len(self.sorted) - 1))][0]
+
+
+class ewma_tracker(min_tracker):
+    name = 'ewma'
+
+    def __init__(self, alpha=.3, **params):
+        min_tracker.__init__(self, **params)
+        self.alpha = alpha
+        self.averages = {}
+
+    def set(self, peer, rate):
+        if peer in self.averages:
+            rate = int(self.alpha * rate + (1 - self.alpha) * self.averages[peer])
+        self.averages[peer] = rate
+        min_tracker.set(self, peer, rate)
+
+    def remove(self, peer):
+        self.averages.pop(peer, None)
+        min_tracker.remove(self, peer)
+
+
+TRACKERS = dict((t.name, t) for t in (min_tracker, percentile_tracker, ewma_tracker))
+
+
+def make_tracker(name='min', **params):
+    if name not in TRACKERS:
+        raise ValueError("Unknown rate policy: " + str(name))
+    return TRACKERS[name](**params)
@@ -7,12 +7,32 @@ import mcast
 parser = argparse.ArgumentParser(description='Process some integers.')
 parser.add_argument('--listen_port', type=int, default=1234)
 parser.add_argument('--multicast_group', type=str, default="0.0.0.0") #224.1.2.3
+parser.add_argument('--backend', type=str, default="sniff", choices=mcast.receiver.backends)
+parser.add_argument('--log_format', type=str, default="text", choices=('text', 'binary'))
+parser.add_argument('--log_sample', type=int, default=1,
+                    help='keep one binary log record out of N, 0 keeps none')
+parser.add_argument('--log_file', type=str, default=None)
+parser.add_argument('--feedback_threshold', type=float, default=0,
+                    help='no feedback while nrate is within this fraction of crate')
+parser.add_argument('--feedback_interval', type=float, default=0,
+                    help='minimum seconds between feedbacks to the same sender')
+parser.add_argument('--feedback_window', type=float, default=0,
+                    help='delay feedback randomly by up to this many seconds')
 
 args = parser.parse_args()
 
 
 def run():
-    receiver = mcast.receiver(multicast_group=args.multicast_group, listen_port=args.listen_port)
+    receiver = mcast.receiver(
+        multicast_group=args.multicast_group,
+        listen_port=args.listen_port,
+        backend=args.backend,
+        log_format=args.log_format,
+        log_sample=args.log_sample,
+        log_file=args.log_file,
+        feedback_threshold=args.feedback_threshold,
+        feedback_interval=args.feedback_interval,
+        feedback_window=args.feedback_window)
     receiver.loop()
 
 if __name__ == '__main__':
@@ -14,18 +14,41 @@ parser.add_argument('--policy', type=str, default="pam")
 #parser.add_argument('--policy', action="store_true", default=False)
 parser.add_argument('--start_sleep', type=float, default=0)
 parser.add_argument('--deadline', type=float, default=0)
+parser.add_argument('--burst', type=int, default=1,
+                    help='packets per sendmmsg() burst, 1 sends packet by packet')
+parser.add_argument('--pacer', type=str, default="sleep",
+                    help='sleep, hybrid, tokenbucket or deadline')
+parser.add_argument('--log_format', type=str, default="text", choices=('text', 'binary'))
+parser.add_argument('--log_sample', type=int, default=1,
+                    help='keep one binary log record out of N, 0 keeps none')
+parser.add_argument('--rate_policy', type=str, default="min",
+                    help='min, percentile or ewma of the receivers\' rates')
+parser.add_argument('--rate_timeout', type=float, default=0,
+                    help='forget receivers silent for that many seconds, 0 never does')
+parser.add_argument('--rate_percentile', type=float, default=10)
+parser.add_argument('--rate_alpha', type=float, default=.3)
 
-args = parser.parse_args()
 
-def run():
-    #global t1
-    t1 = time.time()
-    sender = mcast.sender(
+def sender_params(args):
+    return dict(
         multicast_group=args.multicast_group, 
         listen_port=args.listen_port, 
         pktnum=args.pktnum, 
         policy=args.policy, 
-        deadline=args.deadline)
+        deadline=args.deadline,
+        burst=args.burst,
+        pacer=args.pacer,
+        log_format=args.log_format,
+        log_sample=args.log_sample,
+        rate_policy=args.rate_policy,
+        rate_timeout=args.rate_timeout,
+        rate_percentile=args.rate_percentile,
+        rate_alpha=args.rate_alpha)
+
+def run():
+    #global t1
+    t1 = time.time()
+    sender = mcast.sender(**sender_params(args))
     st = args.start_sleep + t1 - time.time()
     if st < 0:
         st = 0
@@ -33,4 +56,5 @@ def run():
     sender.start()
 
 if __name__ == '__main__':
+    args = parser.parse_args()
     run()
@@ -0,0 +1,592 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline simulator of the PAM egress pipeline of mcast_router.p4.
+
+The register pass replays multicast packet events port by port with the
+same semantics as the P4 program: the crc16 flow hash into
+active_flow_bf_reg, the selected_flow_* registers, active_flow_num_reg
+and the load counters, all with bit<32> wrap-around. Everything that does
+not feed back into the registers is done with NumPy over the whole trace:
+the flow hash, and the nrate_division shift-sum for any number of link
+capacities at once (available_aggr_bw_reg only enters the nrate, never
+the registers). With numba installed the register pass and the shift-sum
+are compiled, which takes the replay from about 0.5M to several million
+events/s; without it they run as Python and NumPy.
+
+    ./mcast_sim.py replay trace.csv --capacity 250000 500000 1000000
+    ./mcast_sim.py policies --flows 20 --capacity 500000
+    ./mcast_sim.py bench --events 1000000
+    ./mcast_sim.py check
+
+A trace is a CSV file with a header and the columns
+port,src,dst,sport,dport,mtype,prio,crate,nrate,length[,multicast].
+The initial switch state comes from the commands files of the app
+(register_write and table_add nrate_division lines).
+"""
+from __future__ import print_function
+
+import argparse
+import csv
+import heapq
+import os
+import random
+import socket
+import struct
+import sys
+import time
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    # the register pass then runs as a plain Python loop
+    njit = None
+
+from mcast import CONFIG
+
+PORT_NUM = 20
+FLOW_NUM = 10000
+MAX_FLOW_PRIO_VALUE = 255
+U32 = 0xffffffff
+
+MCAST_NORMAL = CONFIG['MCAST_NORMAL']
+MCAST_FIN = CONFIG['MCAST_FIN']
+MCAST_PROBE = CONFIG['MCAST_PROBE']
+MCAST_FS = CONFIG['MCAST_FS']
+
+# ipv4.totalLen of a full data packet
+LENGTH = CONFIG['mheader_size'] - 14 + CONFIG['payload_size']
+
+COMMANDS = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'commands_mcast.txt')]
+
+TRACE = np.dtype([
+    ('port', 'u4'), ('src', 'u4'), ('dst', 'u4'), ('sport', 'u2'), ('dport', 'u2'),
+    ('mtype', 'u1'), ('prio', 'u1'), ('crate', 'u4'), ('nrate', 'u4'), ('length', 'u2'),
+    ('multicast', 'u1')])
+
+# what n2rate the egress used for an event
+N2RATE_ZERO = 0      # no rate computed (FIN, non-multicast), n2rate stays 0
+N2RATE_AGGR = 1      # available_aggr_bw
+N2RATE_RESIDUAL = 2  # available_aggr_bw - selected_flow_rate
+
+
+def crc16_table():
+    # bmv2's crc16: CRC-16/ARC, polynomial 0x8005 reflected, init 0
+    table = np.zeros(256, dtype=np.uint32)
+    for i in range(256):
+        crc = i
+        for j in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+        table[i] = crc
+    return table
+
+CRC16_TABLE = crc16_table()
+
+
+def crc16(data):
+    "crc16 of every row of a (n, nbytes) uint8 array"
+    crc = np.zeros(data.shape[0], dtype=np.uint32)
+    for i in range(data.shape[1]):
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ data[:, i]) & 0xff]
+    return crc
+
+
+def flow_hash(trace, flow_num=FLOW_NUM):
+    """
+    hash(flow_hash, crc16, 1, {srcAddr, dstAddr, srcPort, dstPort,
+    (bit<32>) egress_port}, FLOW_NUM) for every event of the trace.
+    """
+    fields = np.zeros(len(trace), dtype=[('src', '>u4'), ('dst', '>u4'), ('sport', '>u2'), ('dport', '>u2'), ('port', '>u4')])
+    for name in fields.dtype.names:
+        fields[name] = trace[name]
+    data = fields.view(np.uint8).reshape(len(trace), fields.dtype.itemsize)
+    return 1 + crc16(data) % flow_num
+
+
+class division_table(object):
+    """
+    nrate_division as arrays indexed by division_num; misses take the
+    default action calc_nrate(0, 32, 32, 32, 32). calc_nrate rows have
+    neg = 0, calc_nrate_signed ones subtract the terms set in neg.
+    """
+    def __init__(self, size=32):
+        self.maxrate = np.zeros(size + 1, dtype=np.uint64)
+        self.shifts = np.full((size + 1, 4), 32, dtype=np.uint64)
+        self.neg = np.zeros((size + 1, 4), dtype=bool)
+
+    def add(self, division_num, maxrate, shifts, neg=0):
+        if division_num >= len(self.maxrate):
+            n = division_num + 1 - len(self.maxrate)
+            self.maxrate = np.concatenate([self.maxrate, np.zeros(n, dtype=np.uint64)])
+            self.shifts = np.concatenate([self.shifts, np.full((n, 4), 32, dtype=np.uint64)])
+            self.neg = np.concatenate([self.neg, np.zeros((n, 4), dtype=bool)])
+        self.maxrate[division_num] = maxrate
+        self.shifts[division_num] = shifts
+        self.neg[division_num] = [neg >> k & 1 for k in range(4)]
+
+    def calc_nrate(self, n2rate, division_num, nrate):
+        """
+        Vectorized calc_nrate; n2rate may carry extra leading dimensions
+        (one per capacity of a sweep) that broadcast against the events.
+        """
+        division_num = np.asarray(division_num, dtype=np.int64)
+        hit = division_num < len(self.maxrate)
+        idx = np.where(hit, division_num, 0)
+        maxrate = np.where(hit, self.maxrate[idx], 0)
+        shifts = np.where(hit[:, None], self.shifts[idx], 32)
+        neg = hit[:, None] & self.neg[idx]
+        n2rate = np.asarray(n2rate, dtype=np.uint64)
+        # n2rate is bit<32>, so shifting it by 32..63 in 64 bits gives the
+        # 0 of bit<32> >> 32; a term goes to add or sub by shifting it
+        # out of the other
+        off = np.uint64(63)
+        add = np.zeros(np.broadcast(n2rate, division_num).shape, dtype=np.uint64)
+        sub = np.zeros_like(add) if neg.any() else None
+        term = np.empty_like(add)
+        for k in range(4):
+            s = np.minimum(shifts[:, k], off)
+            if not (s < 32).any():
+                continue
+            np.right_shift(n2rate, np.where(neg[:, k], off, s), out=term)
+            add += term
+            if sub is not None and neg[:, k].any():
+                np.right_shift(n2rate, np.where(neg[:, k], s, off), out=term)
+                sub += term
+        add &= U32
+        if sub is not None:
+            sub &= U32
+            # clamped at 0 like calc_nrate_signed
+            positive = add > sub
+            np.subtract(add, sub, out=add, where=positive)
+            add[~positive] = 0
+        np.minimum(add, maxrate, out=add)
+        return np.minimum(add, np.asarray(nrate, dtype=np.uint64), out=add)
+
+
+def register_pass(port, fhash, mtype, prio, crate, length, multicast,
+                  sel_id, sel_prio, sel_rate, flow_num_reg, mcast_load, normal_load, bf,
+                  kind, residual, division):
+    """
+    The per-event loop of egress.run, updating the registers and filling
+    kind/residual/division in place. Runs on lists as plain Python, or
+    compiled on arrays when numba is there.
+    """
+    for i in range(len(port)):
+        p = port[i]
+        if not multicast[i]:
+            normal_load[p] = (normal_load[p] + length[i]) & U32
+            continue
+        h, t = fhash[i], mtype[i]
+        selected_flow_id = sel_id[p]
+        active_flow_num = flow_num_reg[p]
+        active = bf[h]
+
+        if active and (t == MCAST_FIN or t == MCAST_PROBE):
+            active = 0
+            active_flow_num = (active_flow_num - 1) & U32
+            if h == selected_flow_id:
+                sel_id[p] = selected_flow_id = 0
+                sel_rate[p] = 0
+                sel_prio[p] = MAX_FLOW_PRIO_VALUE
+        elif not active and (t == MCAST_NORMAL or t == MCAST_FS):
+            active = 1
+            active_flow_num = (active_flow_num + 1) & U32
+
+        if t == MCAST_FS:
+            kind[i], division[i] = N2RATE_AGGR, active_flow_num
+        elif t == MCAST_NORMAL or t == MCAST_PROBE:
+            if prio[i] < sel_prio[p] or h == selected_flow_id:
+                kind[i], division[i] = N2RATE_AGGR, 1
+                if t == MCAST_NORMAL:
+                    sel_id[p] = h
+                    sel_rate[p] = crate[i]
+                    sel_prio[p] = prio[i]
+            else:
+                kind[i], residual[i] = N2RATE_RESIDUAL, sel_rate[p]
+                division[i] = active_flow_num if t == MCAST_NORMAL else (active_flow_num + 1) & U32
+
+        bf[h] = active
+        flow_num_reg[p] = active_flow_num
+        mcast_load[p] = (mcast_load[p] + length[i]) & U32
+
+def nrate_pass(kind, residual, division, nrate, multicast, aggr_bw, maxrate, shifts, neg, out):
+    """
+    n2rate and calc_nrate of every event for every row of aggr_bw (one
+    per capacity; a row of one value per event without a sweep) into
+    out, which is (rows, events). The compiled counterpart of
+    egress.n2rate and division_table.calc_nrate.
+    """
+    per_event = aggr_bw.shape[1] > 1
+    for i in range(out.shape[1]):
+        if not multicast[i]:
+            # non-multicast packets skip nrate_division
+            for c in range(out.shape[0]):
+                out[c, i] = nrate[i]
+            continue
+        d = division[i]
+        # a miss takes the default action, whose maxrate is 0
+        if kind[i] == N2RATE_ZERO or d >= len(maxrate):
+            for c in range(out.shape[0]):
+                out[c, i] = 0
+            continue
+        for c in range(out.shape[0]):
+            n2rate = aggr_bw[c, i] if per_event else aggr_bw[c, 0]
+            if kind[i] == N2RATE_RESIDUAL:
+                n2rate = max(n2rate - residual[i], 0)
+            add, sub = 0, 0
+            for k in range(4):
+                if shifts[d, k] < 32:
+                    if neg[d, k]:
+                        sub += n2rate >> shifts[d, k]
+                    else:
+                        add += n2rate >> shifts[d, k]
+            add &= U32
+            sub &= U32
+            rate = min(add - sub if add > sub else 0, maxrate[d])
+            out[c, i] = min(rate, nrate[i])
+
+compiled_register_pass = compiled_nrate_pass = None
+if njit is not None:
+    compiled_register_pass = njit(nogil=True)(register_pass)
+    compiled_nrate_pass = njit(nogil=True)(nrate_pass)
+
+
+class egress(object):
+    """
+    The egress registers of one switch and a per-event step() that
+    mirrors the apply block of mcast_router.p4.
+    """
+    def __init__(self, port_num=PORT_NUM, flow_num=FLOW_NUM):
+        self.port_num = port_num
+        self.flow_num = flow_num
+        self.selected_flow_rate_reg = [0] * port_num
+        self.selected_flow_id_reg = [0] * port_num
+        self.selected_flow_prio_reg = [0] * port_num
+        self.active_flow_num_reg = [0] * port_num
+        self.mcast_traffic_load_reg = [0] * port_num
+        self.normal_traffic_load_reg = [0] * port_num
+        self.available_aggr_bw_reg = [0] * port_num
+        # the flow hash has base 1, so indices run 1..flow_num
+        self.active_flow_bf_reg = bytearray(flow_num + 1)
+        self.nrate_division = division_table()
+
+    def load_commands(self, filenames=COMMANDS):
+        "Apply the register_write and nrate_division lines of commands files"
+        for filename in filenames:
+            with open(filename) as f:
+                for line in f:
+                    words = line.split()
+                    if len(words) == 4 and words[0] == 'register_write':
+                        getattr(self, words[1])[int(words[2])] = int(words[3])
+                    elif words[:2] == ['table_add', 'nrate_division']:
+                        args = [int(w) for w in words[3:] if w != '=>']
+                        neg = args[6] if words[2] == 'calc_nrate_signed' else 0
+                        self.nrate_division.add(args[0], args[1], args[2:6], neg)
+
+    def step(self, port, fhash, mtype, prio, crate, length):
+        """
+        Update the registers for one multicast packet. Returns
+        (n2rate kind, selected_flow_rate, division_num) for calc_nrate.
+        """
+        kind, residual, division_num = self.run([port], [fhash], [mtype], [prio], [crate], [length], [1])
+        return kind[0], residual[0], division_num[0]
+
+    def run(self, port, fhash, mtype, prio, crate, length, multicast):
+        """
+        The apply block of mcast_router.p4 over sequences of events, in
+        order. Returns kind, residual and division_num, which calc_nrate
+        needs; residual is what available_aggr_bw is reduced by.
+        """
+        n = len(port)
+        regs = [self.selected_flow_id_reg, self.selected_flow_prio_reg, self.selected_flow_rate_reg,
+                self.active_flow_num_reg, self.mcast_traffic_load_reg, self.normal_traffic_load_reg]
+        # single steps of the closed loop are cheaper without the arrays
+        if compiled_register_pass is None or n < 64:
+            events = [a.tolist() if isinstance(a, np.ndarray) else list(a)
+                      for a in (port, fhash, mtype, prio, crate, length, multicast)]
+            out = [[N2RATE_ZERO] * n, [0] * n, [0] * n]
+            register_pass(*(events + regs + [self.active_flow_bf_reg] + out))
+            return out
+
+        events = [np.ascontiguousarray(a, dtype=np.int64) for a in (port, fhash, mtype, prio, crate, length, multicast)]
+        arrays = [np.array(r, dtype=np.int64) for r in regs]
+        out = [np.zeros(n, dtype=np.int8), np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64)]
+        compiled_register_pass(*(events + arrays + [np.frombuffer(self.active_flow_bf_reg, dtype=np.uint8)] + out))
+        for r, a in zip(regs, arrays):
+            r[:] = a.tolist()
+        return out
+
+    def n2rate(self, kind, residual, aggr_bw):
+        "n2rate of the events for one or more (leading axis) capacities"
+        aggr_bw = np.asarray(aggr_bw, dtype=np.int64)
+        # residual is 0 unless kind is N2RATE_RESIDUAL
+        n2rate = np.maximum(aggr_bw - residual, 0)
+        n2rate *= kind != N2RATE_ZERO
+        return n2rate
+
+    def replay(self, trace, capacities=None):
+        """
+        Run the trace through the registers and return the nrate of every
+        event, shape (len(capacities), len(trace)). Without capacities
+        the available_aggr_bw_reg of the event's port is used.
+        """
+        kind, residual, division_num = self.run(
+            trace['port'], flow_hash(trace, self.flow_num), trace['mtype'],
+            trace['prio'], trace['crate'], trace['length'], trace['multicast'])
+        kind = np.array(kind, dtype=np.int8)
+        residual = np.array(residual, dtype=np.int64)
+        division_num = np.array(division_num, dtype=np.int64)
+
+        if capacities is None:
+            aggr_bw = np.array(self.available_aggr_bw_reg, dtype=np.int64)[trace['port']][None, :]
+        else:
+            aggr_bw = np.asarray(capacities, dtype=np.int64)[:, None]
+        if compiled_nrate_pass is not None:
+            table = self.nrate_division
+            nrate = np.empty((len(aggr_bw), len(trace)), dtype=np.uint32)
+            compiled_nrate_pass(kind, residual, division_num, trace['nrate'].astype(np.int64), trace['multicast'], aggr_bw,
+                       table.maxrate.astype(np.int64), table.shifts.astype(np.int64), table.neg, nrate)
+            return nrate
+        nrate = self.nrate_division.calc_nrate(self.n2rate(kind, residual, aggr_bw), division_num, trace['nrate'])
+        # non-multicast packets skip nrate_division
+        return np.where(trace['multicast'].astype(bool), nrate, trace['nrate']).astype(np.uint32)
+
+
+def ip2int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def read_trace(filename):
+    with open(filename) as f:
+        rows = list(csv.DictReader(f))
+    trace = np.zeros(len(rows), dtype=TRACE)
+    for name in TRACE.names:
+        if name in ('src', 'dst'):
+            trace[name] = [ip2int(r[name]) for r in rows]
+        elif name == 'multicast':
+            trace[name] = [int(r.get(name) or 1) for r in rows]
+        else:
+            trace[name] = [int(r[name]) for r in rows]
+    return trace
+
+
+def synthetic_trace(events, flows=50, ports=4, seed=0):
+    "Random data/probe/FIN events of `flows` flows on `ports` ports"
+    rng = np.random.RandomState(seed)
+    trace = np.zeros(events, dtype=TRACE)
+    flow = rng.randint(0, flows, events)
+    trace['port'] = 1 + flow % ports
+    trace['src'] = ip2int('10.0.1.1') + flow % 6
+    trace['dst'] = ip2int('224.1.2.0') + flow % 32
+    trace['sport'] = 40000 + flow
+    trace['dport'] = 1234
+    trace['mtype'] = rng.choice([CONFIG['MCAST_NORMAL'], CONFIG['MCAST_PROBE'], CONFIG['MCAST_FIN']], events, p=[.98, .015, .005])
+    trace['prio'] = rng.randint(0, 256, events)
+    trace['crate'] = rng.randint(0, 500000, events)
+    trace['nrate'] = CONFIG['max_sending_rate']
+    trace['length'] = LENGTH
+    trace['multicast'] = 1
+    return trace
+
+
+class flow(object):
+    "A closed-loop sender of simulate(), with the priorities of mcast.sender"
+    def __init__(self, fid, start, pktnum, deadline, policy, ports):
+        self.fid = fid
+        self.start = start
+        self.pktnum = self.remaining = pktnum
+        self.deadline = deadline
+        self.policy = policy
+        self.ports = ports
+        self.rate = 0
+        self.finish = None
+        self.missed = False
+
+    def prio(self, now):
+        elapsed = now - self.start
+        if self.policy == 'fifo':
+            return max(0, MAX_FLOW_PRIO_VALUE - int(20 * elapsed))
+        if self.policy == 'lifo':
+            return int(20 * elapsed)
+        if self.policy == 'deadline':
+            return int(20 * (self.deadline - elapsed))
+        return self.remaining
+
+    def mtype(self, probe):
+        if self.policy == 'fs':
+            return CONFIG['MCAST_FS']
+        return CONFIG['MCAST_PROBE'] if probe else CONFIG['MCAST_NORMAL']
+
+
+def simulate(flows, capacity, rtt=.001, commands=COMMANDS):
+    """
+    Closed-loop run of senders against one switch: every packet goes
+    through the egress of all ports of its group and the sender moves to
+    the minimum nrate one rtt later, like with receiver feedback.
+    Returns the flows with finish time and deadline misses filled in.
+    """
+    sw = egress()
+    sw.load_commands(commands)
+    sw.available_aggr_bw_reg = [capacity] * sw.port_num
+    length = LENGTH
+    hashes = {}
+    for f in flows:
+        ev = np.zeros(len(f.ports), dtype=TRACE)
+        ev['port'] = f.ports
+        ev['src'], ev['dst'], ev['sport'], ev['dport'] = ip2int('10.0.1.1'), ip2int('224.1.2.3'), 40000 + f.fid, 1234
+        hashes[f.fid] = flow_hash(ev).tolist()
+
+    def egress_nrate(f, mtype, prio, crate, now):
+        nrate = CONFIG['max_sending_rate']
+        for port, fhash in zip(f.ports, hashes[f.fid]):
+            kind, residual, division_num = sw.step(port, fhash, mtype, prio & 0xff, crate, length)
+            n2rate = sw.n2rate(np.array([kind]), residual, capacity)
+            nrate = min(nrate, int(sw.nrate_division.calc_nrate(n2rate, [division_num], [nrate])[0]))
+        return nrate
+
+    events = [(f.start, f.fid, 'send', 0) for f in flows]
+    heapq.heapify(events)
+    byid = dict((f.fid, f) for f in flows)
+    while events:
+        now, fid, what, rate = heapq.heappop(events)
+        f = byid[fid]
+        if f.finish is not None:
+            continue
+        if what == 'feedback':
+            f.rate = rate
+            continue
+        if f.deadline and now - f.start > f.deadline and f.policy == 'deadline':
+            egress_nrate(f, CONFIG['MCAST_FIN'], 0, 0, now)
+            f.finish, f.missed = now, True
+            continue
+        probe = f.rate <= 0
+        nrate = egress_nrate(f, f.mtype(probe), f.prio(now), f.rate, now)
+        if nrate != f.rate:
+            heapq.heappush(events, (now + rtt, fid, 'feedback', nrate))
+        if probe:
+            heapq.heappush(events, (now + CONFIG['probe_interval'] if nrate <= 0 else now + rtt, fid, 'send', 0))
+            continue
+        f.remaining -= 1
+        if f.remaining <= 0:
+            egress_nrate(f, CONFIG['MCAST_FIN'], 0, 0, now)
+            f.finish = now
+            f.missed = bool(f.deadline) and now - f.start > f.deadline
+            continue
+        heapq.heappush(events, (now + length * 8. / f.rate, fid, 'send', 0))
+    return flows
+
+
+def synthetic_flows(n, policy, seed=0, ports=(2, 3, 4)):
+    rnd = random.Random(seed)
+    return [flow(i, rnd.uniform(0, 2), rnd.randint(20, 200), rnd.uniform(2, 8), policy,
+                 rnd.sample(ports, 2)) for i in range(n)]
+
+
+def cmd_replay(args):
+    trace = read_trace(args.trace)
+    sw = egress()
+    sw.load_commands(args.commands)
+    capacities = args.capacity or None
+    nrate = sw.replay(trace, capacities)
+    out = csv.writer(sys.stdout)
+    out.writerow(['event'] + ['nrate_{0}'.format(c) for c in (capacities or ['reg'])])
+    for i in range(len(trace)):
+        out.writerow([i] + nrate[:, i].tolist())
+
+
+def cmd_policies(args):
+    print("{0:<10} {1:>10} {2:>12} {3:>8}".format('policy', 'capacity', 'mean fct (s)', 'missed'))
+    for capacity in args.capacity or [500000]:
+        for policy in args.policy:
+            flows = simulate(synthetic_flows(args.flows, policy, args.seed), capacity, commands=args.commands)
+            fct = [f.finish - f.start for f in flows if f.finish is not None]
+            print("{0:<10} {1:>10} {2:>12.3f} {3:>8}".format(
+                policy, capacity, sum(fct) / max(len(fct), 1), sum(f.missed for f in flows)))
+
+
+def cmd_bench(args):
+    trace = synthetic_trace(args.events, seed=args.seed)
+    capacities = np.linspace(100000, 1000000, args.sweep).astype(np.int64)
+    # compile the register and nrate passes outside the timings
+    egress().replay(trace[:100], capacities)
+    sw = egress()
+    sw.load_commands(args.commands)
+    t1 = time.time()
+    fhash = flow_hash(trace)
+    t2 = time.time()
+    sw.run(trace['port'], fhash, trace['mtype'], trace['prio'], trace['crate'], trace['length'], trace['multicast'])
+    t3 = time.time()
+    sw = egress()
+    sw.load_commands(args.commands)
+    t4 = time.time()
+    sw.replay(trace, capacities)
+    t5 = time.time()
+    print("# {0} events, {1} capacities, register pass {2}".format(
+        args.events, len(capacities), 'compiled (numba)' if compiled_register_pass is not None else 'Python'))
+    print("{0:<24} {1:>12.0f} events/s".format("flow hash", args.events / (t2 - t1)))
+    print("{0:<24} {1:>12.0f} events/s".format("register pass", args.events / (t3 - t2)))
+    print("{0:<24} {1:>12.0f} events/s".format("replay", args.events / (t5 - t4)))
+
+
+def cmd_check(args):
+    """
+    Replay a flow whose hash is FLOW_NUM, the last index of
+    active_flow_bf_reg: it has to become active, be selected and leave
+    again on FIN.
+    """
+    trace = np.zeros(65536, dtype=TRACE)
+    trace['port'], trace['src'], trace['dst'] = 1, ip2int('10.0.1.1'), ip2int('224.1.2.3')
+    trace['sport'], trace['dport'] = np.arange(65536), 1234
+    sport = int(np.nonzero(flow_hash(trace) == FLOW_NUM)[0][0])
+
+    trace = trace[[sport, sport, sport]]
+    trace['mtype'] = [MCAST_NORMAL, MCAST_NORMAL, MCAST_FIN]
+    trace['prio'], trace['crate'], trace['length'], trace['multicast'] = 1, 100000, LENGTH, 1
+    trace['nrate'] = CONFIG['max_sending_rate']
+    sw = egress()
+    sw.load_commands(args.commands)
+    sw.replay(trace[:2], [500000])
+    assert sw.active_flow_bf_reg[FLOW_NUM] == 1 and sw.active_flow_num_reg[1] == 1
+    assert sw.selected_flow_id_reg[1] == FLOW_NUM
+    sw.replay(trace[2:], [500000])
+    assert sw.active_flow_bf_reg[FLOW_NUM] == 0 and sw.active_flow_num_reg[1] == 0
+    assert sw.selected_flow_id_reg[1] == 0
+    print("flow hash {0} (sport {1}): ok".format(FLOW_NUM, sport))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline simulator of the PAM egress pipeline')
+    parser.add_argument('--commands', type=str, nargs='+', default=COMMANDS,
+                        help='commands files with the initial registers and nrate_division')
+    subparsers = parser.add_subparsers(dest='cmd')
+
+    replay_parser = subparsers.add_parser('replay', help='nrate of every event of a trace')
+    replay_parser.add_argument('trace', type=str)
+    replay_parser.add_argument('--capacity', type=int, nargs='*', default=[],
+                               help='available_aggr_bw values to sweep, default the registers')
+    replay_parser.set_defaults(func=cmd_replay)
+
+    policies_parser = subparsers.add_parser('policies', help='closed-loop policy comparison on synthetic flows')
+    policies_parser.add_argument('--flows', type=int, default=20)
+    policies_parser.add_argument('--policy', type=str, nargs='+', default=['fifo', 'lifo', 'deadline', 'pam', 'fs'])
+    policies_parser.add_argument('--capacity', type=int, nargs='*', default=[])
+    policies_parser.add_argument('--seed', type=int, default=0)
+    policies_parser.set_defaults(func=cmd_policies)
+
+    bench_parser = subparsers.add_parser('bench', help='replay throughput on a synthetic trace')
+    bench_parser.add_argument('--events', type=int, default=1000000)
+    bench_parser.add_argument('--sweep', type=int, default=16)
+    bench_parser.add_argument('--seed', type=int, default=0)
+    bench_parser.set_defaults(func=cmd_bench)
+
+    check_parser = subparsers.add_parser('check', help='replay a flow hashing to FLOW_NUM')
+    check_parser.set_defaults(func=cmd_check)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
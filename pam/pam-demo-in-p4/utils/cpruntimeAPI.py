@@ -9,10 +9,21 @@ from __future__ import print_function
 
 import os
 import re
+import binascii
 import sys
 import time
 import pprint
-import json
+import threading
+from array import array
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 """
 from os.path import expanduser
@@ -22,13 +33,210 @@ sys.path.append(os.path.join(home_path, "bmv2/targets/simple_switch"))
 """
 
 import runtime_CLI
+import p4schema
 from sswitch_runtime import SimpleSwitch
 from sswitch_CLI import SimpleSwitchAPI
 
 
 
+class thread_stdout(object):
+    """
+    Stand-in for sys.stdout that lets a thread capture what it prints, the
+    runtime_CLI commands print their results instead of returning them.
+    """
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def write(self, s):
+        buf = getattr(self.local, 'buf', None)
+        (self.stdout if buf is None else buf).write(s)
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+def capture_output(func, *args):
+    "Call func and return what it printed in this thread"
+    if not isinstance(sys.stdout, thread_stdout):
+        sys.stdout = thread_stdout(sys.stdout)
+    local = sys.stdout.local
+    local.buf = StringIO()
+    try:
+        func(*args)
+        return local.buf.getvalue()
+    finally:
+        local.buf = None
+
+
+def typed_array(values, bitwidth):
+    """
+    Register values as a NumPy array, or an array.array without NumPy, of
+    the smallest unsigned type that holds bitwidth bits.
+    """
+    nbytes = 1
+    while nbytes * 8 < bitwidth:
+        nbytes *= 2
+    if np is not None:
+        if nbytes > 8:
+            return np.array(values, dtype=object)
+        return np.array(values, dtype='u%d' % nbytes)
+    for code in 'BHILQ':
+        try:
+            if array(code).itemsize >= nbytes:
+                return array(code, values)
+        except ValueError:  # no 'Q' in python 2
+            break
+    return list(values)
+
+
+def changed_runs(old, new, mask=None):
+    """
+    (start, end, value) for every run of contiguous cells that differ
+    between old and new (and are set in mask) and share one new value;
+    end is exclusive like in bm_register_write_range.
+    """
+    if np is not None:
+        old, new = np.asarray(old), np.asarray(new)
+        changed = old != new
+        if mask is not None:
+            changed &= np.asarray(mask, dtype=bool)
+        idx = np.flatnonzero(changed)
+        if not len(idx):
+            return []
+        # a run breaks where the next changed cell is not adjacent or differs
+        breaks = np.flatnonzero((np.diff(idx) != 1) | (new[idx[1:]] != new[idx[:-1]])) + 1
+        starts = np.concatenate([[0], breaks])
+        ends = np.concatenate([breaks, [len(idx)]])
+        return [(int(idx[a]), int(idx[b - 1]) + 1, int(new[idx[a]])) for a, b in zip(starts, ends)]
+
+    runs = []
+    for i in range(len(new)):
+        if old[i] == new[i] or (mask is not None and not mask[i]):
+            continue
+        if runs and runs[-1][1] == i and runs[-1][2] == new[i]:
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1, new[i]])
+    return [tuple(r) for r in runs]
+
+
+def bytes_to_int(b):
+    return int(binascii.hexlify(b), 16) if b else 0
+
+
+def parse_value(s):
+    "CLI value to int: 10.0.1.1, 00:00:00:00:01:01 or any int literal"
+    if '.' in s:
+        value = 0
+        for b in s.split('.'):
+            value = (value << 8) + int(b)
+        return value
+    if ':' in s:
+        return int(s.replace(':', ''), 16)
+    return int(s, 0)
+
+
+def _masked(name, value, prefix_len, bitwidth):
+    if bitwidth is None:
+        raise ValueError('No bitwidth for lpm field {0} in the P4 JSON, cannot mask /{1}'.format(name, prefix_len))
+    if not 0 <= prefix_len <= bitwidth:
+        raise ValueError('Prefix length {0} out of range for {1}-bit field {2}'.format(prefix_len, bitwidth, name))
+    return value & (((1 << prefix_len) - 1) << (bitwidth - prefix_len))
+
+
+def normalize_key(key_layout, fields, priority=None):
+    """
+    Hashable form of a match key given as CLI strings (10.0.1.1/32,
+    0x0a&&&0xff, 1->5 ...), identical to entry_key() of the same entry as
+    bm_mt_get_entries returns it.
+    """
+    if len(fields) != len(key_layout):
+        raise ValueError('Expected {0} match fields, got {1}'.format(len(key_layout), len(fields)))
+    key = []
+    for (name, match_type, bitwidth), field in zip(key_layout, fields):
+        if match_type == 'lpm':
+            value, prefix_len = field.split('/')
+            prefix_len = int(prefix_len)
+            key.append((_masked(name, parse_value(value), prefix_len, bitwidth), prefix_len))
+        elif match_type == 'ternary':
+            value, mask = [parse_value(v) for v in field.split('&&&')]
+            key.append((value & mask, mask))
+        elif match_type == 'range':
+            key.append(tuple(parse_value(v) for v in field.split('->')))
+        elif match_type == 'valid':
+            key.append(field.lower() in ('1', 'true'))
+        else:
+            key.append(parse_value(field))
+    if any(m in ('ternary', 'range') for _, m, _ in key_layout):
+        key.append(priority)
+    return tuple(key)
+
+
+def entry_key(key_layout, entry):
+    "Normalized match key of a BmMtEntry, see normalize_key()"
+    key = []
+    for (name, match_type, bitwidth), param in zip(key_layout, entry.match_key):
+        if param.lpm is not None:
+            prefix_len = param.lpm.prefix_length
+            key.append((_masked(name, bytes_to_int(param.lpm.key), prefix_len, bitwidth), prefix_len))
+        elif param.ternary is not None:
+            mask = bytes_to_int(param.ternary.mask)
+            key.append((bytes_to_int(param.ternary.key) & mask, mask))
+        elif param.range is not None:
+            key.append((bytes_to_int(param.range.start), bytes_to_int(param.range.end_)))
+        elif param.valid is not None:
+            key.append(bool(param.valid.key))
+        else:
+            key.append(bytes_to_int(param.exact.key))
+    if any(m in ('ternary', 'range') for _, m, _ in key_layout):
+        key.append(entry.options.priority if entry.options is not None else None)
+    return tuple(key)
+
+
+TABLE_WRITES = ('table_add', 'table_modify', 'table_delete', 'table_clear')
+ADDED_HANDLE = re.compile(r'added with handle (\d+)')
+CLI_ERROR = re.compile(r'^(Error|Invalid)', re.M)
+
+
+class TableEntries(object):
+    """
+    Client-side copy of one table: normalized match key -> entry handle and
+    (action, params), filled by one bm_mt_get_entries and kept up to date
+    by the SSHandler table_* methods.
+    """
+    def __init__(self, key_layout, entries=()):
+        self.key_layout = key_layout
+        self.handles = {}
+        self.entries = {}
+        for e in entries:
+            params = tuple(bytes_to_int(d) for d in e.action_entry.action_data)
+            self.add(entry_key(key_layout, e), e.entry_handle, e.action_entry.action_name, params)
+
+    def key(self, fields, priority=None):
+        return normalize_key(self.key_layout, fields, priority)
+
+    def add(self, key, handle, action, params):
+        self.handles[key] = handle
+        self.entries[handle] = (key, action, tuple(params))
+
+    def modify(self, handle, action, params):
+        key = self.entries[handle][0]
+        self.entries[handle] = (key, action, tuple(params))
+
+    def delete(self, handle):
+        key = self.entries.pop(handle)[0]
+        del self.handles[key]
+
+    def handle(self, key):
+        return self.handles.get(key)
+
+    def __len__(self):
+        return len(self.handles)
+
+
 class SSHandler(object):
-    def __init__(self, thrift_ip='localhost', thrift_port=9090):
+    def __init__(self, thrift_ip='localhost', thrift_port=9090, json_path=None):
         pre = runtime_CLI.PreType.SimplePreLAG
         services = runtime_CLI.RuntimeAPI.get_thrift_services(pre)
         services.extend(SimpleSwitchAPI.get_thrift_services())
@@ -36,12 +244,16 @@ class SSHandler(object):
         standard_client, mc_client, sswitch_client = runtime_CLI.thrift_connect(
             thrift_ip, thrift_port, services)
 
-        runtime_CLI.load_json_config(standard_client)
-
-        json_str = standard_client.bm_get_config()
-        self.json_dict =  json.loads(json_str)
+        # indexed once per program (by config md5), see p4schema
+        self.schema, json_path = p4schema.load(standard_client, json_path)
+        runtime_CLI.load_json_config(standard_client, json_path)
         
         self.ssapi = SimpleSwitchAPI(pre, standard_client, mc_client, sswitch_client)
+        self.table_caches = {}
+
+    @property
+    def json_dict(self):
+        return self.schema.json_dict
 
     def get_register_info(self, reg_name=None):
         """ 
@@ -59,14 +271,30 @@ class SSHandler(object):
             "size": 16
         }]
         """
-        if not hasattr(self, "__register_info"):
-            self.__register_info = {
-                it["name"]: it for it in self.json_dict["register_arrays"]
-            }
         if reg_name is None:
-            return self.__register_info.keys()
+            return list(self.schema.registers.keys())
         else:
-            return self.__register_info[reg_name]
+            return self.schema.register(reg_name)
+
+    def run_command(self, line):
+        "Run one simple_switch_CLI command over this connection, returns its output"
+        args = line.split()
+        if len(args) > 1 and args[0] in TABLE_WRITES:
+            # written behind the cache's back, reload it on next use
+            for name in list(self.table_caches):
+                if name == args[1] or name.endswith('.' + args[1]):
+                    del self.table_caches[name]
+        return capture_output(self.ssapi.onecmd, line)
+
+    def _table_command(self, line):
+        output = capture_output(self.ssapi.onecmd, line)
+        if CLI_ERROR.search(output):
+            raise RuntimeError('{0}: {1}'.format(line, output.strip()))
+        return output
+
+    def register_full_name(self, register_name):
+        "Resolve a short register name (e.g. queuelen_reg) like the CLI does"
+        return self.schema.register(register_name)['name']
 
     def show_tables(self):
         self.ssapi.do_show_tables('')
@@ -79,26 +307,22 @@ class SSHandler(object):
         "Display some (non-formatted) information about a table: table_dump <table_name>"
         self.ssapi.do_table_dump(line)
     
+    def table_entries(self, table_name, refresh=False):
+        "The TableEntries of a table, read from the switch once"
+        table = self.schema.table(table_name)
+        if refresh or table['name'] not in self.table_caches:
+            entries = self.ssapi.client.bm_mt_get_entries(0, table['name'])
+            self.table_caches[table['name']] = TableEntries(self.schema.key_layout(table['name']), entries)
+        return self.table_caches[table['name']]
+
+    def get_entry_handle(self, table_name, fields, priority=None):
+        "Handle of the entry matching fields (CLI strings), None if absent"
+        entries = self.table_entries(table_name)
+        return entries.handle(entries.key(fields, priority))
+
     def get_lpm_entry_handle(self, table_name, key_, prefix_len=32):
         "Get the entry handler of a given match_key in a table"
-        #self.ssapi.do_table_dump(table_name)
-        def hexstr(v):
-            return '0x' + "".join("{:02x}".format(ord(c)) for c in v)
-        
-        prefix_ip = 0
-        for s in key_.split('.'):
-            prefix_ip = (prefix_ip << 8) + eval(s)
-        
-        entries = self.ssapi.client.bm_mt_get_entries(0, table_name)
-        for e in entries:
-            entry_handle = e.entry_handle
-            for item in e.match_key:
-                lpm = item.lpm
-                if lpm is None:
-                    continue
-            if lpm.prefix_length == prefix_len and eval(hexstr(lpm.key)) == prefix_ip:
-                return entry_handle
-        return None
+        return self.get_entry_handle(table_name, ['{0}/{1}'.format(key_, prefix_len)])
 
     def register_read(self, register_name, index=None):
         if index is None:
@@ -119,14 +343,84 @@ class SSHandler(object):
 
     
     def get_register_values(self, register_name):
-        regsize = self.get_register_info(register_name)['size']
-        values = [self.register_read(register_name, i) for i in range(regsize)]
-        return values
+        return list(self.register_read(register_name))
+
+    def get_register_array(self, register_name):
+        "The whole register with one RPC, typed by its bitwidth (see typed_array)"
+        return typed_array(self.register_read(register_name), self.get_register_info(register_name)['bitwidth'])
 
+    def register_write_runs(self, register_name, values, old_values=None, mask=None):
+        """
+        Make the register equal to values (where mask is set) with one
+        bm_register_write_range per run of changed cells. old_values is
+        read from the switch if not given. Returns the runs written.
+        """
+        if old_values is None:
+            old_values = self.get_register_array(register_name)
+        runs = changed_runs(old_values, values, mask)
+        for start, end, value in runs:
+            self.ssapi.client.bm_register_write_range(0, register_name, start, end, value)
+        return runs
+
+
+    def table_add(self, table_name, action_name, fields, params=(), priority=None):
+        "Add an entry, returns its handle"
+        entries = self.table_entries(table_name)
+        key = entries.key(fields, priority)
+        line = ' '.join(['table_add', table_name, action_name] + list(fields) + ['=>'] + list(params))
+        if priority is not None:
+            line += ' {0}'.format(priority)
+        handle = int(ADDED_HANDLE.search(self._table_command(line)).group(1))
+        entries.add(key, handle, self.schema.table_action(table_name, action_name)['name'], [parse_value(p) for p in params])
+        return handle
 
     def table_modify(self, line):
         "Add entry to a match table: table_modify <table name> <action name> <entry handle> [action parameters]"
-        return self.ssapi.do_table_modify(line)
+        output = self._table_command('table_modify ' + line)
+        args = line.split()
+        entries = self.table_caches.get(self.schema.table(args[0])['name'])
+        if entries is not None and int(args[2]) in entries.entries:
+            entries.modify(int(args[2]), self.schema.table_action(args[0], args[1])['name'], [parse_value(p) for p in args[3:]])
+        return output
+
+    def table_modify_by_key(self, table_name, action_name, fields, params=(), priority=None):
+        "Modify the entry matching fields, returns its handle (None if absent)"
+        handle = self.get_entry_handle(table_name, fields, priority)
+        if handle is not None:
+            self.table_modify(' '.join([table_name, action_name, str(handle)] + list(params)))
+        return handle
+
+    def table_modify_many(self, table_name, updates):
+        """
+        Modify many entries by key: updates is [(action, fields, params)] or
+        [(action, fields, params, priority)]. Entries whose action and
+        params already match are skipped. Returns the keys not found.
+        """
+        entries = self.table_entries(table_name)
+        missing = []
+        for update in updates:
+            action_name, fields, params = update[:3]
+            key = entries.key(fields, update[3] if len(update) > 3 else None)
+            handle = entries.handle(key)
+            if handle is None:
+                missing.append(fields)
+            elif entries.entries[handle][1:] != (self.schema.table_action(table_name, action_name)['name'],
+                                                 tuple(parse_value(p) for p in params)):
+                self.table_modify(' '.join([table_name, action_name, str(handle)] + list(params)))
+        return missing
+
+    def table_delete(self, table_name, handle):
+        self._table_command('table_delete {0} {1}'.format(table_name, handle))
+        entries = self.table_caches.get(self.schema.table(table_name)['name'])
+        if entries is not None and handle in entries.entries:
+            entries.delete(handle)
+
+    def table_delete_by_key(self, table_name, fields, priority=None):
+        "Delete the entry matching fields, returns its handle (None if absent)"
+        handle = self.get_entry_handle(table_name, fields, priority)
+        if handle is not None:
+            self.table_delete(table_name, handle)
+        return handle
 
     def table_set_default(self, line):
         "Set default action for a match table: table_set_default <table name> <action name> <action parameters>"
@@ -134,17 +428,19 @@ class SSHandler(object):
 
 
 def migrate_register_with_controller(source, target, register_name, default_values):
-    new_values = source.get_register_values(register_name)
-
-    num_dif_cells = 0
-    num_mov_cells = 0
-    for index, new_value in enumerate(new_values):
-        old_value = target.register_read(register_name, index)
-        if old_value != new_value:
-            num_dif_cells += 1
-            if old_value == default_values[index]:
-                num_mov_cells += 1
-                target.register_write(register_name, index, new_value)
+    new_values = source.get_register_array(register_name)
+    old_values = target.get_register_array(register_name)
+
+    # cells still at their default have not been migrated by the data plane
+    if np is not None:
+        dif = np.asarray(old_values) != np.asarray(new_values)
+        movable = dif & (np.asarray(old_values) == np.asarray(default_values))
+        num_dif_cells, num_mov_cells = int(dif.sum()), int(movable.sum())
+    else:
+        movable = [o != n and o == d for o, n, d in zip(old_values, new_values, default_values)]
+        num_dif_cells = sum(o != n for o, n in zip(old_values, new_values))
+        num_mov_cells = sum(movable)
+    target.register_write_runs(register_name, new_values, old_values, mask=movable)
 
     print('='*20, register_name, '='*20)
     print(num_mov_cells, 'states are migrated by controller')
@@ -153,6 +449,77 @@ def migrate_register_with_controller(source, target, register_name, default_valu
     return num_dif_cells, num_mov_cells
 
 
+PAM_REGISTERS = [
+    "egress.selected_flow_rate_reg",
+    "egress.selected_flow_id_reg",
+    "egress.selected_flow_prio_reg",
+    "egress.active_flow_num_reg",
+    "egress.active_flow_bf_reg"]
+
+
+class StateMigration(object):
+    """
+    Pre-copy migration of registers from source to target, like live VM
+    migration: copy the delta between the switches while traffic still
+    runs on source, repeat until the delta is at most `threshold` cells
+    (or `max_rounds` is reached), then call freeze(), copy the last delta
+    and call unfreeze(). freeze/unfreeze are whatever stops and resumes
+    updates on source, e.g. rerouting traffic to target.
+    """
+    def __init__(self, source, target, registers=PAM_REGISTERS, threshold=16, max_rounds=10,
+                 freeze=None, unfreeze=None):
+        self.source = source
+        self.target = target
+        self.registers = registers
+        self.threshold = threshold
+        self.max_rounds = max_rounds
+        self.freeze = freeze
+        self.unfreeze = unfreeze
+
+        self.cell_bytes = dict((r, (source.get_register_info(r)['bitwidth'] + 7) // 8) for r in registers)
+        self.rounds = []
+
+    def copy_delta(self):
+        "One round: copy every changed run, returns (cells, bytes, rpcs)"
+        cells = nbytes = rpcs = 0
+        for r in self.registers:
+            new = self.source.get_register_array(r)
+            old = self.target.get_register_array(r)
+            runs = self.target.register_write_runs(r, new, old)
+            n = sum(end - start for start, end, value in runs)
+            cells += n
+            nbytes += n * self.cell_bytes[r]
+            rpcs += 2 + len(runs)
+        return cells, nbytes, rpcs
+
+    def run(self):
+        t = time.time()
+        while True:
+            cells, nbytes, rpcs = self.copy_delta()
+            self.rounds.append(dict(cells=cells, bytes=nbytes, rpcs=rpcs))
+            if cells <= self.threshold or len(self.rounds) >= self.max_rounds:
+                break
+
+        frozen = time.time()
+        if self.freeze is not None:
+            self.freeze()
+        cells, nbytes, rpcs = self.copy_delta()
+        if self.unfreeze is not None:
+            self.unfreeze()
+        self.rounds.append(dict(cells=cells, bytes=nbytes, rpcs=rpcs, frozen=True))
+        end = time.time()
+
+        return dict(
+            rounds=len(self.rounds),
+            converged=self.rounds[-2]['cells'] <= self.threshold,
+            cells_moved=sum(r['cells'] for r in self.rounds),
+            bytes_moved=sum(r['bytes'] for r in self.rounds),
+            rpcs=sum(r['rpcs'] for r in self.rounds),
+            freeze_window=end - frozen,
+            total_time=end - t,
+            per_round=[r['cells'] for r in self.rounds])
+
+
 def dot_netip_to_tuple(s):
     lst = s.split('/')
     if len(lst) != 2:
@@ -189,9 +556,19 @@ def move_states(port_a, port_b, cared_registers):
     #s1.show_tables()
     s2 = SSHandler(thrift_port=port_b)
     for reg_name in cared_registers:
-        old_values = s2.get_register_values(reg_name)
+        old_values = s2.get_register_array(reg_name)
         migrate_register_with_controller(s1, s2, reg_name, old_values)
 
+
+def precopy_states(port_a, port_b, registers=PAM_REGISTERS, threshold=16):
+    s1 = SSHandler(thrift_port=port_a)
+    s2 = SSHandler(thrift_port=port_b)
+    report = StateMigration(s1, s2, registers, threshold=threshold).run()
+    print('='*20, 'pre-copy migration', '='*20)
+    pprint.pprint(report)
+    print('--'*40)
+    return report
+
     
 def main():
     #cared_registers = ["hh_pktcnt"]
@@ -1,6 +1,22 @@
+import os
+import Queue
 import subprocess
+import sys
+import threading
+import time
+import zlib
 
 from mininet.topo import Topo
+from shortest_path import ShortestPath
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+try:
+    # needs the bmv2 runtime_CLI modules, otherwise every batch of commands
+    # goes through a simple_switch_CLI process
+    from cpruntimeAPI import SSHandler
+    from reconcile import reconcile
+except ImportError:
+    SSHandler = None
 
 
 def isInt(s):
@@ -72,6 +88,9 @@ class AppController:
         self.topo = net.topo
         
         self.switches = self.topo.switches()
+        self.shortestpath = ShortestPath(self.topo.links(), latencies=self.conf.get('latencies'))
+        # spread destinations over equal-cost next hops
+        self.ecmp = self.conf.get('ecmp', True)
 
         self.command_files = {sw: [] for sw in self.switches}
         self.commands = {sw: [] for sw in self.switches}
@@ -79,13 +98,64 @@ class AppController:
         self.mcast_groups_files = {sw: [] for sw in self.switches}
         self.mcast_groups = {sw: {} for sw in self.switches}
         self.last_mcnoderid = 0
+        self.mc_node_count = {sw: 0 for sw in self.switches}
+
+        # one persistent Thrift connection per switch, keyed by thrift port
+        self.use_thrift = SSHandler is not None and self.conf.get('thrift_client', True)
+        self.handlers = {}
+        # send table commands as a diff against what the switches hold
+        self.use_reconcile = self.use_thrift and self.conf.get('reconcile', False)
+
+        # switches and hosts configured in parallel, 1 does one after another
+        self.workers = self.conf.get('bringup_workers', 1)
+        self.lock = threading.Lock()
+        self.timings = []
 
     def start(self):
+        self.createHandlers()
         self.configureHosts()
         self.generateCommands()
         self.sendGeneratedCommands()
         self.setupMcastGroups()
-        self.configurePaths()
+        print 'Bring-up (%d workers): %s' % (self.workers, ', '.join('%s %.3fs' % t for t in self.timings))
+
+    def runPhase(self, phase, jobs):
+        """
+        Run jobs, a list of (key, [callables]), on up to self.workers
+        threads. The callables of one key run in order on the same thread,
+        so everything sent to one switch or host keeps its order.
+        """
+        t = time.time()
+        if self.workers <= 1 or len(jobs) <= 1:
+            for key, calls in jobs:
+                for call in calls:
+                    call()
+        else:
+            queue = Queue.Queue()
+            for job in jobs:
+                queue.put(job)
+            errors = []
+
+            def worker():
+                while True:
+                    try:
+                        key, calls = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        for call in calls:
+                            call()
+                    except Exception as e:
+                        errors.append((key, e))
+
+            threads = [threading.Thread(target=worker) for i in range(min(self.workers, len(jobs)))]
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join()
+            if errors:
+                raise Exception('%s failed on %s: %s' % (phase, errors[0][0], errors[0][1]))
+        self.timings.append((phase, time.time() - t))
 
     def readCommands(self, filename):
         commands = []
@@ -105,11 +175,39 @@ class AppController:
             parsed['handle'] = int(s.split('created with handle', 1)[-1].split()[0])
         return parsed
 
+    def createHandlers(self):
+        """
+        Connect to every switch before the parallel phases: runtime_CLI
+        keeps the loaded JSON config in module globals, so connecting from
+        a worker would reset it under the other workers' commands.
+        """
+        if not self.use_thrift:
+            return
+        for sw_name in self.switches:
+            sw = self.net.get(sw_name)
+            if sw.thrift_port in self.handlers:
+                continue
+            try:
+                self.handlers[sw.thrift_port] = SSHandler(thrift_port=sw.thrift_port, json_path=getattr(sw, 'json_path', None))
+            except Exception as e:
+                print 'Thrift connection to port %d failed (%s), using %s' % (sw.thrift_port, e, self.cli_path)
+                self.handlers[sw.thrift_port] = None
+
+    def getHandler(self, thrift_port):
+        # None (use the CLI) for ports createHandlers() did not connect
+        return self.handlers.get(thrift_port)
+
     def sendCommands(self, commands, thrift_port=9090, sw=None):
         if sw: 
             thrift_port = sw.thrift_port
 
         print '\n'.join(commands)
+        handler = self.getHandler(thrift_port)
+        if handler is not None:
+            raw_results = [handler.run_command(c) for c in commands]
+            print ''.join(raw_results)
+            return map(self.parseCliOutput, raw_results)
+
         p = subprocess.Popen([self.cli_path, '--thrift-port', str(thrift_port)], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
         stdout, nostderr = p.communicate(input='\n'.join(commands))
         print stdout
@@ -140,8 +238,12 @@ class AppController:
         return groups
 
     def createMcastGroup(self, mgid, ports, sw=None):
-        self.last_mcnoderid += 1
-        commands = ['mc_node_create %d %s' % (self.last_mcnoderid, ' '.join(map(str, ports)))]
+        with self.lock:
+            self.last_mcnoderid += 1
+            rid = self.last_mcnoderid
+            if sw:
+                self.mc_node_count[sw.name] += 1
+        commands = ['mc_node_create %d %s' % (rid, ' '.join(map(str, ports)))]
         results = self.sendCommands(commands, sw=sw)
 
         handle = results[-1]['handle']
@@ -154,54 +256,170 @@ class AppController:
 
         self.sendCommands(commands, sw=sw)
 
+    def createMcastGroups(self, groups, sw):
+        """
+        Program all groups ({mgid: ports}) of a switch with one batch of
+        commands. bmv2 hands out node handles in order from 0, so the
+        handles are predicted to associate nodes in the same batch; the
+        handles that came back are checked and fixed up with a second
+        batch if another client created nodes in between.
+        """
+        if 'model' in self.conf and self.conf['model'].lower() != 'bmv2':
+            for mgid in sorted(groups):
+                self.createMcastGroup(mgid, groups[mgid], sw=sw)
+            return
+
+        mgids = sorted(groups)
+        first = self.mc_node_count[sw.name]
+        predicted = dict((mgid, first + i) for i, mgid in enumerate(mgids))
+        self.mc_node_count[sw.name] += len(mgids)
+
+        # node ids are per switch, in mgid order
+        commands = ['mc_node_create %d %s' % (first + i + 1, ' '.join(map(str, groups[mgid]))) for i, mgid in enumerate(mgids)]
+        commands += ['mc_mgrp_create %d' % mgid for mgid in mgids]
+        commands += ['mc_node_associate %d %d' % (mgid, predicted[mgid]) for mgid in mgids]
+        results = self.sendCommands(commands, sw=sw)
+
+        fixes = []
+        for mgid, result in zip(mgids, results):
+            if 'handle' not in result:
+                raise Exception('mc_node_create failed for group %d on %s: %s' % (mgid, sw.name, result['raw']))
+            if result['handle'] != predicted[mgid]:
+                fixes += ['mc_node_dissociate %d %d' % (mgid, predicted[mgid]),
+                          'mc_node_associate %d %d' % (mgid, result['handle'])]
+        if fixes:
+            self.sendCommands(fixes, sw=sw)
+
     def readRegister(self, register, idx, thrift_port=9090, sw=None):
         if sw: 
             thrift_port = sw.thrift_port
+        handler = self.getHandler(thrift_port)
+        if handler is not None:
+            return long(handler.register_read(handler.register_full_name(register), idx))
+
         p = subprocess.Popen([self.cli_path, '--thrift-port', str(thrift_port)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         stdout, stderr = p.communicate(input="register_read %s %d" % (register, idx))
         reg_val = filter(lambda l: ' %s[%d]' % (register, idx) in l, stdout.split('\n'))[0].split('= ', 1)[1]
         return long(reg_val)
 
     def configureHosts(self):
-        for h in self.net.hosts:
-            h_name = h.name
-            h_ip = self.topo.ip_info[h_name]
-            h_mac = h.MAC()
-            h.setIP(h_ip, prefixLen=32)
-            
-            s_name = self.topo.tor[h.name]
-            s = self.net.get(s_name)
-            h_port, s_port = self.topo.port(h_name, s_name)
-            s_mac = s.MAC(intf=s.intfs[s_port])
-            s_ip = self.topo.ip_info[s_name]
-            iface = h.defaultIntf().name
-            h.cmd('ifconfig %s %s hw ether %s' % (iface, h_ip, h_mac))
-            h.cmd('arp -i %s -s %s %s' % (iface, s_ip, s_mac))
-            h.cmd('ethtool --offload %s rx off tx off' % iface)
-            h.cmd('ip route add %s dev %s' % (s_ip, iface))
-            h.setDefaultRoute("via %s" % s_ip)
+        self.runPhase('host config', [(h.name, [lambda h=h: self.configureHost(h)]) for h in self.net.hosts])
+
+    def configureHost(self, h):
+        h_name = h.name
+        h_ip = self.topo.ip_info[h_name]
+        h_mac = h.MAC()
+        h.setIP(h_ip, prefixLen=32)
+        
+        s_name = self.topo.tor[h.name]
+        s = self.net.get(s_name)
+        h_port, s_port = self.topo.port(h_name, s_name)
+        s_mac = s.MAC(intf=s.intfs[s_port])
+        s_ip = self.topo.ip_info[s_name]
+        iface = h.defaultIntf().name
+        h.cmd('ifconfig %s %s hw ether %s' % (iface, h_ip, h_mac))
+        h.cmd('arp -i %s -s %s %s' % (iface, s_ip, s_mac))
+        h.cmd('ethtool --offload %s rx off tx off' % iface)
+        h.cmd('ip route add %s dev %s' % (s_ip, iface))
+        h.setDefaultRoute("via %s" % s_ip)
 
     def configurePaths(self):
-        return
-        for s in  self.net.hosts:
-            for d in self.net.hosts:
-                if s == d: 
-                    continue
-                path = self.shortestpath.get(h.name, h2.name, exclude=lambda n: n in self.topo._host_links)
-                if not path: 
+        """
+        ipv4_lpm routes towards the hosts that are not attached to a switch.
+        Destinations sharing a set of equal-cost next hops are ordered by a
+        hash of (switch, host) and dealt round-robin over that set, so they
+        spread evenly and differently on every switch.
+        """
+        hosts = set(self.topo.hosts())
+        for sw in self.switches:
+            routed = set(c.split()[3] for c in self.commands[sw] if c.startswith('table_add ipv4_lpm '))
+            groups = {}
+            for h in hosts:
+                if '%s/32' % self.topo.ip_info[h] in routed:
                     continue
-                h_link = self.topo._host_links[h.name][path[1]]
-                h2_link = self.topo._host_links[h2.name][path[-2]]
-                h.cmd('ip route add %s via %s' % (h2_link['host_ip'], h_link['sw_ip']))
+                hops = self.shortestpath.equalCostNextHops(sw, h, exclude=lambda n: n in hosts)
+                if hops:
+                    groups.setdefault(tuple(hops if self.ecmp else hops[:1]), []).append(h)
+            for hops, dsts in sorted(groups.items()):
+                dsts.sort(key=lambda h: (zlib.crc32('%s %s' % (sw, h)) & 0xffffffff, h))
+                for i, h in enumerate(dsts):
+                    nhop = hops[i % len(hops)]
+                    port = self.topo.port(sw, nhop)[0]
+                    self.commands[sw].append('table_add ipv4_lpm set_nhop %s/32 => %s %d' % (
+                        self.topo.ip_info[h], self.topo.ip_info[nhop], port))
+
+    def configureMcastTrees(self):
+        """
+        Multicast groups across switches: hosts list the group addresses
+        they join ('mcast_join') and send to ('mcast_send') in the target
+        config. Each group gets one tree spanning its hosts (Steiner
+        approximation, every link carries one copy). Every switch on it
+        replicates to its tree ports that lead to a receiver, since the
+        egress drops the copy that would go back out the ingress port, and
+        routes the group address to the group. Hosts that only send are
+        not replicated to, so they do not count as receivers at the
+        egress; groups without receivers are left out. A group that the
+        mcast_groups files define on a switch is left as it is there.
+        """
+        receivers, senders = {}, {}
+        for h, h_conf in sorted(self.conf.get('hosts', {}).items()):
+            for addr in h_conf.get('mcast_join', []):
+                receivers.setdefault(addr, []).append(h)
+            for addr in h_conf.get('mcast_send', []):
+                senders.setdefault(addr, []).append(h)
+        if not receivers:
+            return
+
+        # a group keeps the mgid the command files route it to, new ones
+        # get mgids neither the routes nor the mcast_groups files use
+        mgids = {}
+        used = set()
+        for sw in self.switches:
+            used.update(self.mcast_groups[sw])
+            for c in self.commands[sw]:
+                w = c.split()
+                if w[:3] == ['table_add', 'ipv4_lpm', 'multicast']:
+                    mgids.setdefault(w[3].split('/')[0], int(w[-1]))
+        used.update(mgids.values())
+        next_mgid = max(list(used) + [0]) + 1
+
+        hosts = set(self.topo.hosts())
+        for addr in sorted(receivers):
+            if addr not in mgids:
+                mgids[addr] = next_mgid
+                next_mgid += 1
+            ports = {}
+            for u, v in self.shortestpath.deliveryEdges(receivers[addr], senders.get(addr, []),
+                                                        exclude=lambda n: n in hosts):
+                if u not in hosts:
+                    ports.setdefault(u, []).append(self.topo.port(u, v)[0])
+            for sw, sw_ports in sorted(ports.items()):
+                if mgids[addr] not in self.mcast_groups[sw]:
+                    self.mcast_groups[sw][mgids[addr]] = sorted(sw_ports)
+                if not any(c.split()[1:2] == ['ipv4_lpm'] and c.split()[3:4] == ['%s/32' % addr] for c in self.commands[sw]):
+                    self.commands[sw].append('table_add ipv4_lpm multicast %s/32 => %d' % (addr, mgids[addr]))
 
     def generateCommands(self):
         self.loadCommands()
+        # before the trees, which must not reuse the files' mgids
+        self.loadMcastGroups()
         self.generateDefaultCommands()
+        self.configurePaths()
+        self.configureMcastTrees()
 
     def sendGeneratedCommands(self):
-        for sw_name in self.commands:
-            sw = self.net.get(sw_name)
-            self.sendCommands(self.commands[sw_name], sw=sw)
+        send = self.reconcileCommands if self.use_reconcile else self.sendCommands
+        self.runPhase('table population', [
+            (sw_name, [lambda sw_name=sw_name: send(self.commands[sw_name], sw=self.net.get(sw_name))])
+            for sw_name in self.commands])
+
+    def reconcileCommands(self, commands, sw):
+        handler = self.getHandler(sw.thrift_port)
+        if handler is None:
+            return self.sendCommands(commands, sw=sw)
+        stats = reconcile(handler, commands)
+        print '%s: %d added, %d modified, %d deleted, %d unchanged' % (
+            sw.name, stats['add'], stats['modify'], stats['delete'], stats['unchanged'])
 
     def loadCommands(self):
         for sw in self.switches:
@@ -224,11 +442,9 @@ class AppController:
                 self.commands[sw] += self.readCommands(filename)
 
     def setupMcastGroups(self):
-        self.loadMcastGroups()
-
-        for sw in self.switches:
-            for mgid, ports in self.mcast_groups[sw].iteritems():
-                self.createMcastGroup(mgid, ports, sw=self.net.get(sw))
+        self.runPhase('mcast groups', [
+            (sw, [lambda sw=sw: self.createMcastGroups(self.mcast_groups[sw], self.net.get(sw))])
+            for sw in self.switches if self.mcast_groups[sw]])
 
     def loadMcastGroups(self):
         for sw in self.switches:
@@ -296,3 +512,37 @@ class AppController:
 
     def stop(self):
         pass
+
+
+if __name__ == '__main__':
+    # s1 - s2 - s3; h1 sends, h2 joins, h3 joins and sends, h4 only sends
+    manifest = {'targets': {'t': {
+        'links': [['h1', 's1'], ['s1', 's2'], ['h2', 's2'], ['s2', 's3'], ['h3', 's3'], ['h4', 's3']],
+        'hosts': {
+            'h1': {'mcast_send': ['224.1.2.2', '224.1.2.9']},
+            'h2': {'mcast_join': ['224.1.2.2', '224.1.2.9']},
+            'h3': {'mcast_join': ['224.1.2.9'], 'mcast_send': ['224.1.2.9']},
+            'h4': {'mcast_send': ['224.1.2.9']}},
+        'switches': {}}}}
+
+    class FakeNet:
+        topo = AppTopo(manifest, 't')
+
+    ctl = AppController(manifest, 't', FakeNet)
+    port = lambda u, v: FakeNet.topo.port(u, v)[0]
+    ctl.commands['s1'].append('table_add ipv4_lpm multicast 224.1.2.2/32 => 2')
+    # as if s2's mcast_groups file had group 3
+    ctl.mcast_groups['s2'][3] = [port('s2', 'h2')]
+    ctl.configureMcastTrees()
+
+    # 224.1.2.9 takes mgid 4, neither routed nor in a file; nothing is
+    # replicated towards h1 or h4, which only send
+    assert ctl.mcast_groups['s1'] == {2: [port('s1', 's2')], 4: [port('s1', 's2')]}
+    assert ctl.mcast_groups['s2'] == {2: [port('s2', 'h2')], 3: [port('s2', 'h2')],
+                                      4: sorted([port('s2', 'h2'), port('s2', 's3')])}
+    assert ctl.mcast_groups['s3'] == {4: sorted([port('s3', 'h3'), port('s3', 's2')])}
+    assert ctl.commands['s1'] == ['table_add ipv4_lpm multicast 224.1.2.2/32 => 2',
+                                  'table_add ipv4_lpm multicast 224.1.2.9/32 => 4']
+    assert ctl.commands['s2'] == ['table_add ipv4_lpm multicast 224.1.2.2/32 => 2',
+                                  'table_add ipv4_lpm multicast 224.1.2.9/32 => 4']
+    assert ctl.commands['s3'] == ['table_add ipv4_lpm multicast 224.1.2.9/32 => 4']
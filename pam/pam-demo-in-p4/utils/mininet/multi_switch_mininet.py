@@ -24,7 +24,7 @@ import argparse
 import json
 import importlib
 import re
-from time import sleep
+from time import time
 
 from mininet.net import Mininet
 from mininet.topo import Topo
@@ -157,9 +157,11 @@ def main():
         controller = AppController(manifest=manifest, target=args.target,
                                      topo=topo, net=net, cli_path=args.cli_path)
 
+    t = time()
     net.start()
-
-    sleep(1)
+    # Mininet versions without batchStartup return before the switches are up
+    P4Switch.batchStartup(net.switches)
+    info('*** %d switches up in %.3fs\n' % (len(net.switches), time() - t))
 
     if controller: 
         controller.start()
@@ -21,6 +21,7 @@ from sys import exit
 import os
 import tempfile
 import socket
+import time
 
 class P4Host(Host):
     def config(self, **params):
@@ -55,6 +56,8 @@ class P4Host(Host):
 class P4Switch(Switch):
     """P4 virtual switch"""
     device_id = 0
+    # seconds batchStartup waits for all switches together
+    startup_timeout = 60
 
     def __init__(self, name, sw_path = None, json_path = None,
                  log_file = None,
@@ -92,24 +95,71 @@ class P4Switch(Switch):
             self.device_id = P4Switch.device_id
             P4Switch.device_id += 1
         self.nanomsg = "ipc:///tmp/bm-{}-log.ipc".format(self.device_id)
+        self.pid = None
+        self.start_time = None
+        self.startup_latency = None
 
     @classmethod
     def setup(cls):
         pass
 
+    @classmethod
+    def batchStartup(cls, switches, timeout=None):
+        """Wait for the switches launched by start() to come up, all at once.
+        Mininet calls this after starting every switch of the class. Each
+        round polls the Thrift port of every pending switch, then sleeps
+        with exponential backoff (5 ms to 0.5 s) until all are ready or
+        timeout seconds have passed. Returns the switches that started."""
+        timeout = cls.startup_timeout if timeout is None else timeout
+        pending = [s for s in switches if isinstance(s, P4Switch) and s.pid and s.startup_latency is None]
+        deadline = time.time() + timeout
+        delay = 0.005
+        while pending:
+            for sw in list(pending):
+                ready = sw.check_thrift_ready()
+                if ready is None:
+                    continue
+                if not ready:
+                    error("P4 switch {} did not start correctly.\n".format(sw.name))
+                    exit(1)
+                pending.remove(sw)
+                sw.startup_latency = time.time() - sw.start_time
+                info("P4 switch {} has been started in {:.3f}s.\n".format(sw.name, sw.startup_latency))
+            if not pending:
+                break
+            if time.time() >= deadline:
+                error("P4 switches {} did not start within {}s.\n".format(
+                    ' '.join(sw.name for sw in pending), timeout))
+                exit(1)
+            time.sleep(min(delay, max(deadline - time.time(), 0)))
+            delay = min(delay * 2, 0.5)
+        return [s for s in switches if getattr(s, 'startup_latency', None) is not None]
+
+    def check_thrift_ready(self):
+        """True once the Thrift server accepts connections, False if the
+        process is gone, None while it is still initializing"""
+        if not os.path.exists(os.path.join("/proc", str(self.pid))):
+            return False
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(0.5)
+            return sock.connect_ex(("localhost", self.thrift_port)) == 0 or None
+        finally:
+            sock.close()
+
     def check_switch_started(self, pid):
         """While the process is running (pid exists), we check if the Thrift
         server has been started. If the Thrift server is ready, we assume that
         the switch was started successfully. This is only reliable if the Thrift
         server is started at the end of the init process"""
+        self.pid = pid
+        delay = 0.005
         while True:
-            if not os.path.exists(os.path.join("/proc", str(pid))):
-                return False
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(0.5)
-            result = sock.connect_ex(("localhost", self.thrift_port))
-            if result == 0:
-                return  True
+            ready = self.check_thrift_ready()
+            if ready is not None:
+                return ready
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
 
     def start(self, controllers):
         "Start up a new P4 switch"
@@ -135,15 +185,15 @@ class P4Switch(Switch):
         info(' '.join(args) + "\n")
 
         pid = None
+        self.start_time = time.time()
+        self.startup_latency = None
         with tempfile.NamedTemporaryFile() as f:
             # self.cmd(' '.join(args) + ' > /dev/null 2>&1 &')
             self.cmd(' '.join(args) + ' >' + self.log_file + ' 2>&1 & echo $! >> ' + f.name)
             pid = int(f.read())
         debug("P4 switch {} PID is {}.\n".format(self.name, pid))
-        if not self.check_switch_started(pid):
-            error("P4 switch {} did not start correctly.\n".format(self.name))
-            exit(1)
-        info("P4 switch {} has been started.\n".format(self.name))
+        # readiness is awaited for all switches together, see batchStartup
+        self.pid = pid
 
     def stop(self):
         "Terminate P4 switch."
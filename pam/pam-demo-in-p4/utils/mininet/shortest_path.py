@@ -1,33 +1,196 @@
+import heapq
+from collections import deque
+
+# latency strings as in the p4app.json links, e.g. 10ms, 500us, 1s
+LATENCY_UNITS = [('us', 1e-3), ('ms', 1.), ('s', 1e3)]
+
+
+def parseLatency(lat):
+    "Latency in ms from a number (ms) or a string with a unit"
+    if isinstance(lat, (int, float)):
+        return float(lat)
+    lat = lat.strip()
+    for unit, scale in LATENCY_UNITS:
+        if lat.endswith(unit):
+            return float(lat[:-len(unit)]) * scale
+    return float(lat)
+
+
 class ShortestPath:
+    """
+    Shortest paths by hop count (BFS) or, when edges have latencies, by
+    latency with hop count breaking ties (Dijkstra). A next-hop table
+    towards every node is built once, on the first query after the
+    topology changed, so get() only walks the path.
+    """
 
-    def __init__(self, edges=[]):
+    def __init__(self, edges=[], latencies=None):
         self.neighbors = {}
+        self.weights = {}
+        # {(a, b): latency} in either order, like conf['latencies']
+        self.latencies = latencies or {}
+        self.next_hops = None
+        self.distances = None
         for edge in edges:
             self.addEdge(*edge)
 
-    def addEdge(self, a, b):
+    def addEdge(self, a, b, latency=None):
         if a not in self.neighbors: self.neighbors[a] = []
         if b not in self.neighbors[a]: self.neighbors[a].append(b)
 
         if b not in self.neighbors: self.neighbors[b] = []
         if a not in self.neighbors[b]: self.neighbors[b].append(a)
 
-    def get(self, a, b, exclude=lambda node: False):
-        # Shortest path from a to b
-        return self._recPath(a, b, [], exclude)
+        if latency is None:
+            latency = self.latencies.get((a, b), self.latencies.get((b, a)))
+        if latency is not None:
+            self.weights[(a, b)] = self.weights[(b, a)] = parseLatency(latency)
+        self.next_hops = None
+        self.distances = None
 
-    def _recPath(self, a, b, visited, exclude):
+    def get(self, a, b, exclude=lambda node: False):
+        # Shortest path from a to b, not going through excluded nodes
         if a == b: return [a]
-        new_visited = visited + [a]
-        paths = []
-        for neighbor in self.neighbors[a]:
-            if neighbor in new_visited: continue
-            if exclude(neighbor) and neighbor != b: continue
-            path = self._recPath(neighbor, b, new_visited, exclude)
-            if path: paths.append(path)
+        if a not in self.neighbors or b not in self.neighbors: return None
+        path = self._walk(self.nextHops()[b], a)
+        if path and any(exclude(n) for n in path[1:-1]):
+            # the precomputed path crosses an excluded node, search around it
+            path = self._walk(self._tree(b, exclude), a)
+        return path
+
+    def nextHop(self, a, b):
+        "Neighbor of a on the shortest path to b, None if unreachable"
+        return self.nextHops()[b].get(a) if b in self.neighbors else None
+
+    def nextHops(self):
+        "{destination: {node: next hop towards destination}}"
+        if self.next_hops is None:
+            self.next_hops, self.distances = {}, {}
+            for b in self.neighbors:
+                self.distances[b] = {}
+                self.next_hops[b] = self._tree(b, dist=self.distances[b])
+        return self.next_hops
+
+    def equalCostNextHops(self, a, b, exclude=lambda node: False):
+        "Every neighbor of a that starts a shortest path to b"
+        if a == b or b not in self.neighbors: return []
+        self.nextHops()
+        dist = self.distances[b]
+        if a not in dist: return []
+        hops = []
+        for n in self.neighbors[a]:
+            if n not in dist or (exclude(n) and n != b): continue
+            if self.weights:
+                cost = (dist[n][0] + self.weights.get((a, n), 0.), dist[n][1] + 1)
+                if abs(cost[0] - dist[a][0]) < 1e-9 and cost[1] == dist[a][1]: hops.append(n)
+            elif dist[n] + 1 == dist[a]:
+                hops.append(n)
+        return hops
 
-        paths.sort(key=len)
-        return [a] + paths[0] if len(paths) else None
+    def steinerTree(self, terminals, exclude=lambda node: False):
+        """
+        Edges (parent, child) of a tree spanning the terminals, grown from
+        the first one by attaching the nearest terminal left through its
+        shortest path (at most twice the cost of the minimum Steiner tree).
+        """
+        self.nextHops()
+        terminals = [t for i, t in enumerate(terminals) if t in self.neighbors and t not in terminals[:i]]
+        if not terminals: return []
+        tree = set(terminals[:1])
+        edges = []
+        left = terminals[1:]
+        while left:
+            best = None
+            for t in left:
+                dist = self.distances[t]
+                for v in tree:
+                    if v in dist and (best is None or dist[v] < best[0]):
+                        best = (dist[v], t, v)
+            if best is None: break
+            path = self.get(best[2], best[1], exclude)
+            if path is None:
+                left.remove(best[1])
+                continue
+            for a, b in zip(path, path[1:]):
+                if b not in tree:
+                    edges.append((a, b))
+                    tree.add(b)
+            left = [t for t in left if t not in tree]
+        return edges
+
+    def deliveryEdges(self, receivers, senders=[], exclude=lambda node: False):
+        """
+        Directed edges (u, v) of the steinerTree over receivers and senders
+        that copies have to go along: those with a receiver on v's side.
+        Branches leading only to senders carry traffic towards the tree but
+        get none back.
+        """
+        edges = self.steinerTree(list(receivers) + list(senders), exclude)
+        adj = {}
+        for a, b in edges:
+            adj.setdefault(a, []).append(b)
+            adj.setdefault(b, []).append(a)
+        receivers = set(receivers)
+
+        def behind(u, v):
+            # a receiver reachable from v without going back over (u, v)
+            seen, stack = set([u, v]), [v]
+            while stack:
+                n = stack.pop()
+                if n in receivers: return True
+                for m in adj[n]:
+                    if m not in seen:
+                        seen.add(m)
+                        stack.append(m)
+            return False
+
+        return [(u, v) for a, b in edges for u, v in ((a, b), (b, a)) if behind(u, v)]
+
+    def _walk(self, tree, a):
+        if a not in tree: return None
+        path = [a]
+        while tree[path[-1]] is not None:
+            path.append(tree[path[-1]])
+        return path
+
+    def _tree(self, root, exclude=None, dist=None):
+        # {node: next hop towards root}; excluded nodes are reached but
+        # never passed through. dist gets the distance of every node.
+        if dist is None: dist = {}
+        if self.weights:
+            return self._dijkstra(root, exclude, dist)
+        tree = {root: None}
+        dist[root] = 0
+        queue = deque([root])
+        while queue:
+            node = queue.popleft()
+            for neighbor in self.neighbors[node]:
+                if neighbor in tree: continue
+                tree[neighbor] = node
+                dist[neighbor] = dist[node] + 1
+                if exclude is None or not exclude(neighbor):
+                    queue.append(neighbor)
+        return tree
+
+    def _dijkstra(self, root, exclude, dist):
+        # cost is (latency, hops), edges without a latency cost 0 ms
+        tree = {}
+        dist[root] = (0., 0)
+        heap = [(0., 0, 0, root, None)]
+        seq = 1
+        while heap:
+            lat, hops, _, node, parent = heapq.heappop(heap)
+            if node in tree: continue
+            tree[node] = parent
+            if node != root and exclude is not None and exclude(node): continue
+            for neighbor in self.neighbors[node]:
+                if neighbor in tree: continue
+                cost = (lat + self.weights.get((node, neighbor), 0.), hops + 1)
+                if neighbor in dist and dist[neighbor] <= cost: continue
+                dist[neighbor] = cost
+                heapq.heappush(heap, (cost[0], cost[1], seq, neighbor, node))
+                seq += 1
+        return tree
 
 if __name__ == '__main__':
 
@@ -76,3 +239,29 @@ if __name__ == '__main__':
     assert sp.get(1, 7) == None
     assert sp.get(7, 2) == None
 
+
+    assert sp.get(2, 6, exclude=lambda n: n == 4) == [2, 1, 3, 6]
+    assert sp.get(4, 1, exclude=lambda n: n in (2, 3)) == [4, 6, 5, 1]
+    assert sp.get(2, 6, exclude=lambda n: n in (1, 4)) == None
+    assert sp.nextHop(2, 6) == 4
+    assert sp.equalCostNextHops(1, 6) == [3, 5]
+    assert sp.equalCostNextHops(1, 6, exclude=lambda n: n == 3) == [5]
+    assert sp.equalCostNextHops(1, 7) == []
+
+    assert sp.steinerTree([2]) == []
+    assert sp.steinerTree([2, 4, 6]) == [(2, 4), (4, 6)]
+    assert len(sp.steinerTree([1, 4, 6])) == 3
+    assert sp.steinerTree([2, 6, 7]) == [(2, 4), (4, 6)]
+    # 6 only sends: 4 forwards its copies to 2, nothing goes back to 6
+    assert sorted(sp.deliveryEdges([2, 4], [6])) == [(2, 4), (4, 2), (6, 4)]
+    assert sorted(sp.deliveryEdges([2, 4, 6])) == [(2, 4), (4, 2), (4, 6), (6, 4)]
+    assert sp.deliveryEdges([], [2, 6]) == []
+
+    assert parseLatency('500us') == 0.5 and parseLatency('2ms') == 2 and parseLatency(3) == 3
+
+    wsp = ShortestPath(edges, latencies={(1, 3): '10ms', (3, 4): '1ms'})
+    assert wsp.get(1, 6) == [1, 5, 6]
+    assert wsp.get(1, 4) == [1, 2, 4]
+    assert wsp.get(3, 2) == [3, 5, 1, 2]
+    assert wsp.get(1, 7) == None
+    assert wsp.equalCostNextHops(1, 6) == [5]
@@ -87,6 +87,7 @@ def main():
                   switch = P4Switch,
                   controller = None)
     net.start()
+    P4Switch.batchStartup(net.switches)
 
 
     sw_mac = ["00:aa:bb:00:00:%02x" % n for n in xrange(num_hosts)]
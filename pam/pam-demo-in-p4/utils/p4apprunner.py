@@ -17,8 +17,12 @@ from __future__ import print_function
 
 import argparse
 from collections import OrderedDict
+import hashlib
 import json
 import os
+import re
+import shutil
+import subprocess
 import sys
 import tarfile
 
@@ -33,6 +37,14 @@ parser.add_argument('--json', help='Use this compiled JSON file instead of compi
                     type=str, action='store', required=False, default=None)
 parser.add_argument('--manifest', help='Path to manifest file.',
                     type=str, action='store', required=False, default='./p4app.json')
+parser.add_argument('--no-compile-cache', help='Always run the compiler.',
+                    action='store_true', required=False, default=False)
+parser.add_argument('--compile-cache-dir', help='Where compiled programs are kept between runs.',
+                    type=str, action='store', required=False,
+                    default=os.environ.get('P4APP_COMPILE_CACHE',
+                                           os.path.join(os.path.expanduser('~'), '.cache', 'p4app')))
+parser.add_argument('--compile-cache-size', help='Size limit of the compile cache in MB.',
+                    type=float, action='store', required=False, default=256)
 parser.add_argument('app', help='.p4app package to run.', type=str)
 parser.add_argument('target', help=('Target to run. Defaults to the first target '
                                     'in the package.'),
@@ -91,6 +103,121 @@ def read_manifest(manifest_file):
 def get_program_name(program_file):
     return os.path.basename(program_file).rstrip('.p4')
 
+INCLUDE_RE = re.compile(r'^\s*#\s*include\s+"([^"]+)"', re.M)
+
+def p4_sources(program_file, include_dirs=()):
+    """The program and every file it #includes with quotes, transitively.
+    <...> includes come with the compiler and are covered by its version."""
+    sources = []
+    pending = [os.path.abspath(program_file)]
+    while pending:
+        path = pending.pop(0)
+        if path in sources:
+            continue
+        sources.append(path)
+        with open(path) as f:
+            text = f.read()
+        for name in INCLUDE_RE.findall(text):
+            for d in [os.path.dirname(path)] + list(include_dirs):
+                candidate = os.path.abspath(os.path.join(d, name))
+                if os.path.isfile(candidate):
+                    pending.append(candidate)
+                    break
+    return sources
+
+def compiler_version(compiler):
+    "Version output, path, size and mtime of the compiler binary"
+    try:
+        version = subprocess.check_output([compiler, '--version'], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as e:
+        version = str(e).encode('utf-8')
+    path = compiler
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        if os.path.isfile(os.path.join(d, compiler)):
+            path = os.path.join(d, compiler)
+            break
+    stat = os.stat(path) if os.path.isfile(path) else None
+    return version + ('%s %s %s' % (path, stat and stat.st_size, stat and stat.st_mtime)).encode('utf-8')
+
+def compile_cache_key(compiler, compiler_args, program_file):
+    "Hash of the sources (with includes), the compiler and its flags"
+    include_dirs = []
+    for arg in compiler_args:
+        for flag in arg.split():
+            if flag.startswith('-I') and len(flag) > 2:
+                include_dirs.append(flag[2:].strip('"'))
+    h = hashlib.sha256()
+    h.update(compiler_version(compiler))
+    h.update(json.dumps(compiler_args).encode('utf-8'))
+    for path in p4_sources(program_file, include_dirs):
+        with open(path, 'rb') as f:
+            data = f.read()
+        h.update(('%s %d\n' % (os.path.relpath(path, os.path.dirname(os.path.abspath(program_file))),
+                                len(data))).encode('utf-8'))
+        h.update(data)
+    return h.hexdigest()
+
+def compile_cache_stats(cache_dir, hit=None):
+    "Hit/miss counters of the cache, counting one more lookup if hit is given"
+    stats_file = os.path.join(cache_dir, 'stats.json')
+    try:
+        with open(stats_file) as f:
+            stats = json.load(f)
+    except (IOError, ValueError):
+        stats = {'hits': 0, 'misses': 0}
+    if hit is not None:
+        stats['hits' if hit else 'misses'] += 1
+        try:
+            tmp = '%s.%d.tmp' % (stats_file, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(stats, f)
+            os.rename(tmp, stats_file)
+        except (IOError, OSError):
+            pass
+    return stats
+
+def compile_cache_evict(cache_dir, max_bytes):
+    "Drop the least recently used entries until the cache fits in max_bytes"
+    entries = []
+    try:
+        names = os.listdir(cache_dir)
+    except OSError as e:
+        log_error('Compile cache not evicted:', e)
+        return
+    for name in names:
+        if name.endswith('.json') and name != 'stats.json':
+            try:
+                st = os.stat(os.path.join(cache_dir, name))
+            except OSError:
+                # evicted by a concurrent run
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        path = os.path.join(cache_dir, name)
+        try:
+            os.remove(path)
+            log('Compile cache evicted', name)
+        except OSError as e:
+            # gone already is as good as evicted
+            if os.path.exists(path):
+                log_error('Compile cache entry not evicted:', e)
+                continue
+        total -= size
+
+def compile_cache_store(cached_file, output_file):
+    "Copy a fresh compiler output into the cache; a cache that cannot be written is skipped"
+    try:
+        tmp = '%s.%d.tmp' % (cached_file, os.getpid())
+        shutil.copyfile(output_file, tmp)
+        os.rename(tmp, cached_file)
+    except (IOError, OSError) as e:
+        log_error('Compile cache not updated:', e)
+        return False
+    return True
+
 def run_compile_bmv2(manifest):
     if 'run-before-compile' in manifest.target_config:
         commands = manifest.target_config['run-before-compile']
@@ -117,11 +244,45 @@ def run_compile_bmv2(manifest):
             sys.exit(1)
         compiler_args.extend(flags)
 
-    # Compile the program.
+    # Compile the program, unless the same sources went through the same
+    # compiler with the same flags before.
     output_file = get_program_name(manifest.program_file) + '.json'
+    cached_file = None
+    if not args.no_compile_cache:
+        try:
+            if not os.path.isdir(args.compile_cache_dir):
+                os.makedirs(args.compile_cache_dir)
+            key = compile_cache_key('p4c-bm2-ss', compiler_args, manifest.program_file)
+            cached_file = os.path.join(args.compile_cache_dir, key + '.json')
+        except (IOError, OSError) as e:
+            log_error('Compile cache disabled:', e)
     compiler_args.append('"%s"' % manifest.program_file)
     compiler_args.append('-o "%s"' % output_file)
-    rv = run_command('p4c-bm2-ss %s' % ' '.join(compiler_args))
+
+    hit = False
+    if cached_file and os.path.isfile(cached_file):
+        try:
+            shutil.copyfile(cached_file, output_file)
+            hit = True
+        except (IOError, OSError) as e:
+            # e.g. evicted by a concurrent run since isfile()
+            log_error('Compile cache entry unusable, compiling:', e)
+    if hit:
+        try:
+            # the mtime is the entry's last use for eviction
+            os.utime(cached_file, None)
+        except OSError:
+            pass
+        stats = compile_cache_stats(args.compile_cache_dir, hit=True)
+        log('Compile cache hit %s (%d hits, %d misses).' % (key[:12], stats['hits'], stats['misses']))
+        rv = 0
+    else:
+        rv = run_command('p4c-bm2-ss %s' % ' '.join(compiler_args))
+        if cached_file and rv == 0:
+            stats = compile_cache_stats(args.compile_cache_dir, hit=False)
+            log('Compile cache miss %s (%d hits, %d misses).' % (key[:12], stats['hits'], stats['misses']))
+            if compile_cache_store(cached_file, output_file):
+                compile_cache_evict(args.compile_cache_dir, args.compile_cache_size * 1024 * 1024)
 
     if 'run-after-compile' in manifest.target_config:
         commands = manifest.target_config['run-after-compile']
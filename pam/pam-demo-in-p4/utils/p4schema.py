@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Index of a compiled bmv2 JSON config: registers, tables (with their key
+layout), actions (with their parameters) and field bitwidths, looked up
+by full or short name.
+
+Indexes are keyed by the config's md5 (bm_get_config_md5, one cheap RPC)
+and kept in memory and on disk, together with the config itself, so a
+new connection to a switch running a known program neither downloads
+nor parses the JSON again:
+
+    schema, json_path = p4schema.load(standard_client)
+    runtime_CLI.load_json_config(standard_client, json_path)
+    schema.register('active_flow_bf_reg')['bitwidth']
+
+The disk cache lives in $P4SCHEMA_CACHE or ~/.cache/p4schema.
+"""
+from __future__ import print_function
+
+import binascii
+import hashlib
+import json
+import os
+
+CACHE_DIR = os.environ.get('P4SCHEMA_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'p4schema'))
+
+_schemas = {}
+
+
+class Schema(object):
+    def __init__(self, index, json_path=None):
+        self.md5 = index['md5']
+        self.registers = index['registers']
+        self.tables = index['tables']
+        self.actions = index['actions']
+        self.aliases = index['aliases']
+        self.json_path = json_path
+        self._json_dict = None
+
+    @classmethod
+    def build(cls, json_dict, md5, json_path=None):
+        fields = {}
+        header_types = dict((t['name'], t) for t in json_dict.get('header_types', []))
+        for h in json_dict.get('headers', []):
+            for f in header_types[h['header_type']]['fields']:
+                fields['{0}.{1}'.format(h['name'], f[0])] = f[1]
+
+        registers = dict((r['name'], r) for r in json_dict.get('register_arrays', []))
+        actions = {}
+        for a in json_dict.get('actions', []):
+            actions[a['name']] = dict(id=a['id'], name=a['name'],
+                                      params=[dict(name=p['name'], bitwidth=p['bitwidth'])
+                                              for p in a.get('runtime_data', [])])
+        tables = {}
+        for pipeline in json_dict.get('pipelines', []):
+            for t in pipeline['tables']:
+                key = [dict(name=k.get('name', '.'.join(k['target'])), match_type=k['match_type'],
+                            bitwidth=fields.get('.'.join(k['target'])))
+                       for k in t['key']]
+                tables[t['name']] = dict(id=t['id'], name=t['name'], pipeline=pipeline['name'], key=key,
+                                         match_type=t.get('match_type'), size=t.get('max_size'),
+                                         actions=t.get('actions', []))
+
+        # short names the CLI accepts too: egress.queuelen_reg -> queuelen_reg
+        aliases = {}
+        for kind, names in (('register', registers), ('table', tables), ('action', actions)):
+            for name in names:
+                parts = name.split('.')
+                for i in range(1, len(parts)):
+                    alias = '.'.join(parts[i:])
+                    # ambiguous short names do not resolve
+                    aliases[kind + ':' + alias] = None if kind + ':' + alias in aliases else name
+
+        index = dict(md5=md5, registers=registers, tables=tables, actions=actions, aliases=aliases)
+        schema = cls(index, json_path)
+        schema._json_dict = json_dict
+        return schema
+
+    def index(self):
+        return dict(md5=self.md5, registers=self.registers, tables=self.tables,
+                    actions=self.actions, aliases=self.aliases)
+
+    def resolve(self, kind, name, names):
+        if name in names:
+            return name
+        full = self.aliases.get(kind + ':' + name)
+        if full is None:
+            raise KeyError('Unknown or ambiguous {0}: {1}'.format(kind, name))
+        return full
+
+    def register(self, name):
+        return self.registers[self.resolve('register', name, self.registers)]
+
+    def table(self, name):
+        return self.tables[self.resolve('table', name, self.tables)]
+
+    def action(self, name):
+        return self.actions[self.resolve('action', name, self.actions)]
+
+    def table_action(self, table_name, name):
+        "An action of table_name; short names resolve among the table's own actions first"
+        if name not in self.actions:
+            matches = [a for a in self.table(table_name)['actions'] if a.endswith('.' + name)]
+            if len(matches) == 1:
+                return self.actions[matches[0]]
+        return self.action(name)
+
+    def key_layout(self, table_name):
+        "[(field name, match type, bitwidth)] of the table's match key"
+        return [(k['name'], k['match_type'], k['bitwidth']) for k in self.table(table_name)['key']]
+
+    @property
+    def json_dict(self):
+        "The whole config, only parsed when asked for"
+        if self._json_dict is None:
+            with open(self.json_path) as f:
+                self._json_dict = json.load(f)
+        return self._json_dict
+
+
+def _paths(md5, cache_dir):
+    return os.path.join(cache_dir, md5 + '.json'), os.path.join(cache_dir, md5 + '.index.json')
+
+
+def _save(schema, json_str, cache_dir):
+    json_path, index_path = _paths(schema.md5, cache_dir)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        for path, data in ((json_path, json_str), (index_path, json.dumps(schema.index()))):
+            tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.rename(tmp, path)
+    except (IOError, OSError):
+        return None
+    return json_path
+
+
+def load(standard_client=None, json_path=None, cache_dir=CACHE_DIR):
+    """
+    The Schema of the config a switch runs (or of json_path) and the path
+    of a file holding that config, for runtime_CLI.load_json_config.
+    """
+    json_str = None
+    if json_path is not None:
+        with open(json_path) as f:
+            json_str = f.read()
+        md5 = hashlib.md5(json_str.encode('utf-8') if not isinstance(json_str, bytes) else json_str).hexdigest()
+    else:
+        md5 = binascii.hexlify(standard_client.bm_get_config_md5())
+        if not isinstance(md5, str):
+            md5 = md5.decode('ascii')
+
+    if md5 in _schemas:
+        schema = _schemas[md5]
+        return schema, json_path or schema.json_path
+
+    cached_json, index_path = _paths(md5, cache_dir)
+    if os.path.isfile(index_path) and os.path.isfile(cached_json):
+        with open(index_path) as f:
+            schema = Schema(json.load(f), cached_json)
+    else:
+        if json_str is None:
+            json_str = standard_client.bm_get_config()
+        schema = Schema.build(json.loads(json_str), md5)
+        # without a disk cache runtime_CLI has to fetch the config itself
+        schema.json_path = _save(schema, json_str, cache_dir) or json_path
+    _schemas[md5] = schema
+    return schema, json_path or schema.json_path
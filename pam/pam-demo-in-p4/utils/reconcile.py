@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Program tables declaratively: the desired state is a list of CLI commands
+(the commands_*.txt files or AppController's generated ones), the current
+state is read once per table, and only the differences are sent:
+
+    ./reconcile.py --thrift_port 9090 commands_ipv4.txt commands_forward.txt commands_mcast.txt
+
+Every table that appears in a table_add is managed: entries with the same
+key and action data are left alone, changed ones are modified in place,
+missing ones added and (unless --keep) unknown ones deleted. Tables no
+table_add mentions are not touched. table_set_default and register
+writes are idempotent and sent as they are; other commands (mc_*, ...)
+are not replayed.
+"""
+from __future__ import print_function
+
+import argparse
+from collections import OrderedDict
+
+from cpruntimeAPI import SSHandler, parse_value
+
+IDEMPOTENT = ('table_set_default', 'register_write', 'register_reset')
+
+
+def parse_table_add(handler, line):
+    "(table, action, fields, params, priority) of a table_add command"
+    args = line.split()
+    table = handler.schema.table(args[1])
+    sep = args.index('=>') if '=>' in args else len(args)
+    fields, params = args[3:sep], args[sep + 1:]
+    priority = None
+    if any(k['match_type'] in ('ternary', 'range') for k in table['key']):
+        priority = int(params.pop())
+    return table['name'], args[2], fields, params, priority
+
+
+def desired_state(handler, commands):
+    """
+    {table: {key: (action, fields, params, priority)}} from the table_add
+    commands, and the idempotent commands to send as they are.
+    """
+    tables, others = {}, []
+    for line in commands:
+        args = line.split()
+        if not args:
+            continue
+        if args[0] == 'table_add':
+            table, action, fields, params, priority = parse_table_add(handler, line)
+            key = handler.table_entries(table).key(fields, priority)
+            # the CLI rejects a second add of a key, keep the first like it
+            tables.setdefault(table, OrderedDict()).setdefault(key, (action, fields, params, priority))
+        elif args[0] in IDEMPOTENT:
+            others.append(line)
+        else:
+            print('Not replayed: ' + line)
+    return tables, others
+
+
+def plan(handler, tables, prune=True):
+    """
+    [('delete', table, handle)], [('modify', table, handle, action, params)]
+    and [('add', table, action, fields, params, priority)] turning the
+    switch's entries into tables.
+    """
+    deletes, modifies, adds = [], [], []
+    for table, desired in sorted(tables.items()):
+        current = handler.table_entries(table)
+        for key, (action, fields, params, priority) in desired.items():
+            handle = current.handle(key)
+            if handle is None:
+                adds.append(('add', table, action, fields, params, priority))
+            elif current.entries[handle][1:] != (handler.schema.table_action(table, action)['name'],
+                                                 tuple(parse_value(p) for p in params)):
+                modifies.append(('modify', table, handle, action, params))
+        if prune:
+            deletes += [('delete', table, handle)
+                        for key, handle in sorted(current.handles.items(), key=lambda kv: kv[1]) if key not in desired]
+    # deletes first so adds never run into a full table
+    return deletes + modifies + adds
+
+
+def apply(handler, ops):
+    for op in ops:
+        if op[0] == 'delete':
+            handler.table_delete(op[1], op[2])
+        elif op[0] == 'modify':
+            handler.table_modify(' '.join([op[1], op[3], str(op[2])] + list(op[4])))
+        else:
+            handler.table_add(*op[1:])
+
+
+def reconcile(handler, commands, prune=True, dry_run=False):
+    "Bring the switch behind handler to the state commands describe, returns counts per operation"
+    tables, others = desired_state(handler, commands)
+    ops = plan(handler, tables, prune)
+    stats = dict(add=0, modify=0, delete=0)
+    for op in ops:
+        stats[op[0]] += 1
+    stats['unchanged'] = sum(len(d) for d in tables.values()) - stats['add'] - stats['modify']
+    if not dry_run:
+        apply(handler, ops)
+        for line in others:
+            handler.run_command(line)
+    return stats
+
+
+def read_commands(filename):
+    with open(filename) as f:
+        return [l.strip() for l in f if l.strip() and not l.strip().startswith('#')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply command files to a running switch as a diff')
+    parser.add_argument('--thrift_ip', type=str, default='localhost')
+    parser.add_argument('--thrift_port', type=int, default=9090)
+    parser.add_argument('--json', type=str, default=None, help='JSON config the switch runs')
+    parser.add_argument('--keep', action='store_true', help='do not delete entries the commands do not list')
+    parser.add_argument('--dry_run', action='store_true')
+    parser.add_argument('commands', nargs='+', help='command files')
+    args = parser.parse_args()
+
+    handler = SSHandler(args.thrift_ip, args.thrift_port, args.json)
+    commands = []
+    for filename in args.commands:
+        commands += read_commands(filename)
+    print(reconcile(handler, commands, prune=not args.keep, dry_run=args.dry_run))
+
+
+if __name__ == '__main__':
+    main()
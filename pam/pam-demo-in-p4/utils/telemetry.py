@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Register telemetry for running bmv2 switches.
+
+One thread per switch polls the chosen registers every `interval` seconds
+with one bm_register_read_all per register and appends the timestamped
+sample to a columnar ring buffer (a timestamp column plus one
+samples x cells array per register). A flusher thread writes what is new
+in every buffer to <out>/<switch>-<n>.npz every flush_interval seconds.
+
+    ./telemetry.py --switch s1:9090 --switch s2:9091 --interval 0.05 --duration 10
+
+Per-port rates are derived from the deltas of mcast_traffic_load_reg and
+normal_traffic_load_reg (byte counters that wrap at 2**32), see
+port_rates() and load_series().
+"""
+from __future__ import print_function
+
+import argparse
+import glob
+import os
+import threading
+import time
+
+import numpy as np
+
+from cpruntimeAPI import SSHandler
+
+LOAD_REGISTERS = [
+    "egress.mcast_traffic_load_reg",
+    "egress.normal_traffic_load_reg"]
+
+DEFAULT_REGISTERS = [
+    "egress.selected_flow_rate_reg",
+    "egress.selected_flow_id_reg",
+    "egress.selected_flow_prio_reg",
+    "egress.active_flow_num_reg"] + LOAD_REGISTERS
+
+
+class SeriesBuffer(object):
+    """
+    Columnar ring buffer of register samples with one producer (the
+    poller) and one consumer (the flusher); the producer only moves head,
+    the consumer only moves tail, so neither takes a lock.
+    """
+    def __init__(self, registers, sizes, dtypes, capacity=4096):
+        self.registers = registers
+        self.capacity = capacity
+        self.ts = np.zeros(capacity, dtype=np.float64)
+        self.columns = dict((r, np.zeros((capacity, sizes[r]), dtype=dtypes[r])) for r in registers)
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+
+    def append(self, ts, values):
+        if self.head - self.tail >= self.capacity:
+            self.dropped += 1
+            return
+        i = self.head % self.capacity
+        self.ts[i] = ts
+        for r in self.registers:
+            self.columns[r][i] = values[r]
+        self.head += 1
+
+    def take(self):
+        "Everything appended since the last take(), as (ts, {register: array})"
+        head, tail = self.head, self.tail
+        idx = np.arange(tail, head) % self.capacity
+        ts = self.ts[idx]
+        columns = dict((r, self.columns[r][idx]) for r in self.registers)
+        self.tail = head
+        return ts, columns
+
+
+class SwitchPoller(threading.Thread):
+    def __init__(self, name, handler, registers=DEFAULT_REGISTERS, interval=.05, capacity=4096):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = name
+        self.handler = handler
+        self.registers = registers
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.late = 0
+
+        sizes, dtypes = {}, {}
+        for r in registers:
+            values = handler.get_register_array(r)
+            sizes[r], dtypes[r] = len(values), getattr(values, 'dtype', np.uint64)
+        self.buffer = SeriesBuffer(registers, sizes, dtypes, capacity)
+
+    def sample(self):
+        values = dict((r, self.handler.get_register_array(r)) for r in self.registers)
+        # one timestamp per sample, taken after the reads
+        self.buffer.append(time.time(), values)
+
+    def run(self):
+        next_t = time.time()
+        while not self.stopped.is_set():
+            self.sample()
+            next_t += self.interval
+            delay = next_t - time.time()
+            if delay < 0:
+                # too slow for the interval, skip ticks instead of bursting
+                self.late += 1
+                next_t = time.time()
+                continue
+            self.stopped.wait(delay)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Telemetry(object):
+    def __init__(self, switches, registers=DEFAULT_REGISTERS, interval=.05, out='telemetry',
+                 flush_interval=1., capacity=4096):
+        """switches maps a name to a thrift port."""
+        self.out = out
+        self.flush_interval = flush_interval
+        self.chunks = {}
+        if not os.path.isdir(out):
+            os.makedirs(out)
+        # runtime_CLI keeps the JSON config in module globals, connect one by one
+        self.pollers = [SwitchPoller(name, SSHandler(thrift_port=port), registers, interval, capacity)
+                        for name, port in sorted(switches.items())]
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_loop)
+        self.flusher.daemon = True
+
+    def start(self):
+        for p in self.pollers:
+            p.start()
+        self.flusher.start()
+
+    def flush(self):
+        for p in self.pollers:
+            ts, columns = p.buffer.take()
+            if not len(ts):
+                continue
+            n = self.chunks.get(p.name, 0)
+            self.chunks[p.name] = n + 1
+            filename = os.path.join(self.out, '{0}-{1:06d}.npz'.format(p.name, n))
+            np.savez_compressed(filename, ts=ts, **dict((r.replace('.', '__'), v) for r, v in columns.items()))
+
+    def flush_loop(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        for p in self.pollers:
+            p.stop()
+        for p in self.pollers:
+            p.join()
+        self.stopped.set()
+        self.flusher.join()
+        self.flush()
+        return dict((p.name, dict(dropped=p.buffer.dropped, late=p.late)) for p in self.pollers)
+
+
+def load_series(out, switch):
+    "Concatenate the flushed chunks of a switch: (ts, {register: array})"
+    ts, columns = [], {}
+    for filename in sorted(glob.glob(os.path.join(out, switch + '-*.npz'))):
+        chunk = np.load(filename)
+        ts.append(chunk['ts'])
+        for key in chunk.files:
+            if key != 'ts':
+                columns.setdefault(key.replace('__', '.'), []).append(chunk[key])
+    if not ts:
+        return np.zeros(0), {}
+    return np.concatenate(ts), dict((r, np.concatenate(v)) for r, v in columns.items())
+
+
+def port_rates(ts, load):
+    """
+    Per-port rate in bit/s between consecutive samples of a byte counter
+    register (samples x ports) that wraps at 2**32.
+    """
+    delta = np.diff(np.asarray(load, dtype=np.int64), axis=0) % (1 << 32)
+    dt = np.diff(ts)[:, None]
+    return np.where(dt > 0, delta * 8. / np.where(dt > 0, dt, 1), 0.)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Poll switch registers into time series')
+    parser.add_argument('--switch', type=str, action='append', default=[],
+                        help='name:thrift_port, can be repeated')
+    parser.add_argument('--register', type=str, action='append', default=[],
+                        help='register to poll, can be repeated, default the PAM egress registers')
+    parser.add_argument('--interval', type=float, default=.05)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--flush_interval', type=float, default=1.)
+    parser.add_argument('--out', type=str, default='telemetry')
+    args = parser.parse_args()
+
+    switches = dict((s.split(':')[0], int(s.split(':')[1])) for s in args.switch or ['s1:9090'])
+    registers = args.register or DEFAULT_REGISTERS
+    t = Telemetry(switches, registers, args.interval, args.out, args.flush_interval)
+    t.start()
+    try:
+        time.sleep(args.duration)
+    except KeyboardInterrupt:
+        pass
+    print(t.stop())
+
+    for name in sorted(switches):
+        ts, columns = load_series(args.out, name)
+        print('{0}: {1} samples'.format(name, len(ts)))
+        for r in LOAD_REGISTERS:
+            if r in columns and len(ts) > 1:
+                rates = port_rates(ts, columns[r])
+                print('  {0} mean bit/s per port: {1}'.format(r, np.round(rates.mean(axis=0)).astype(int).tolist()))
+
+
+if __name__ == '__main__':
+    main()